@@ -1,19 +1,82 @@
 #!/usr/bin/env python
 
 
+import codecs
 import collections
 import vobject
 import datetime
 import copy
+import heapq
+import mmap
+import StringIO
+import hashlib
+import re
+
+import icalutil.recurrence
+
+
+def itercomponents(vobj,
+        names = None,
+        descend = None,
+        root = True,
+        ):
+    '''
+    Yield the components of a component tree lazily (breadth-first), starting
+    with 'vobj' itself unless 'root' is False. 'vobj' may also be a sequence
+    of components, each the root of a tree.
+
+    Only components named in 'names' are yielded, and only the children of
+    components named in 'descend' are visited (by default, all components).
+    A component's children are visited after it has been yielded, so the
+    caller may still remove some of them; to exit early, stop iterating.
+    '''
+    if hasattr(vobj, 'components'):
+        vobj = [vobj,]
+    for tree in vobj:
+        if root and (names is None or tree.name in names):
+            yield tree
+        if descend is not None and tree.name not in descend:
+            continue
+        components = collections.deque(tree.components())
+        while components:
+            component = components.popleft()
+            if names is None or component.name in names:
+                yield component
+            if descend is None or component.name in descend:
+                components.extend(component.components())
 
 
 def walkcomponents(vobj, f, arg):
     '''Walk a component tree (breadth-first).'''
-    components = collections.deque([vobj,])
-    while components:
-        component = components.popleft()
+    for component in itercomponents(vobj):
         f(component, arg)
-        components.extend([component for component in vobj.components()])
+
+
+def filterchildren(vobj, f, arg, filtered):
+    '''
+    Filter the descendants of a component (breadth-first); remove components
+    when 'f' returns False and append them to 'filtered', and replace them
+    when it returns a list of components.
+    '''
+    for component in itercomponents(vobj):
+        removed = len(filtered)
+        replaced = []
+        for c in component.components():
+            accepted = f(c, arg)
+            if not accepted:
+                filtered.append(c)
+            elif isinstance(accepted, list):
+                replaced.append((c, accepted))
+        if removed < len(filtered) or replaced:
+            changedcomponent(component)
+            if component is not vobj:
+                changedcomponent(vobj)      # its text includes component's
+        for i in xrange(removed, len(filtered)):
+            component.remove(filtered[i])
+        for c, replacements in replaced:
+            component.remove(c)
+            for replacement in replacements:
+                component.add(replacement)
 
 
 def filtercomponents(vobj, f, arg):
@@ -24,21 +87,432 @@ def filtercomponents(vobj, f, arg):
     filtered = []
     if not f(vobj, arg):
         raise Exception('Can\'t filter root component')
-    components = collections.deque([vobj,])
-    while components:
-        component = components.popleft()
-        remove = []
-        for c in component.components():
-            if f(c, arg):
-                components.append(c)
-            else:
-                remove.append(c)
-        for c in remove:
-            component.remove(c)
-        filtered.extend(remove)
+    filterchildren(vobj, f, arg, filtered)
     return filtered
 
 
+def filtercomponent(component, f, arg, filtered):
+    '''
+    Filter a top-level component and its descendants. 'f' may also return a
+    list of components to replace the component with, whose descendants are
+    filtered in turn. Return the list of accepted components; a removed
+    component is appended to 'filtered'.
+    '''
+    accepted = f(component, arg)
+    if not accepted:
+        filtered.append(component)
+        return []
+    if not isinstance(accepted, list):
+        accepted = [component]
+    for c in accepted:
+        filterchildren(c, f, arg, filtered)
+    return accepted
+
+
+def filterstream(components, f, arg, filtered):
+    '''
+    Filter a stream of components (as returned by readcomponents()); yield the
+    components for which 'f' returns True (or the components in the list it
+    returns), with their descendants filtered in the same way. Removed
+    components are appended to 'filtered'.
+    '''
+    for component in components:
+        for c in filtercomponent(component, f, arg, filtered):
+            yield c
+
+
+filterstate = {}
+
+
+def filterinit(f, arg):
+    '''Initialize a filterparallel() worker process.'''
+    filterstate['f'] = f
+    filterstate['arg'] = arg
+    filterstate['timezones'] = set()
+
+
+def filterchunk(chunk):
+    '''
+    Filter a chunk of serialized components in a filterparallel() worker;
+    return a list of (accepted, text) pairs and the chunk's copy of 'arg'.
+    '''
+    timezones, texts = chunk
+    for text in timezones:
+        if text not in filterstate['timezones']:
+            parsecomponent(text)        # register the TZID in this process
+            filterstate['timezones'].add(text)
+    f = filterstate['f']
+    arg = copy.deepcopy(filterstate['arg'])
+    results = []
+    for text in texts:
+        accepted = filtercomponent(parsesource(text), f, arg, [])
+        for component in accepted:
+            results.append((True, componenttext(component) or
+                serializecomponent(component)))
+        if not accepted:
+            results.append((False, text))
+    return results, arg
+
+
+def filterparallel(components, f, arg, filtered,
+        processes = None,
+        chunksize = 256,
+        merge = None,
+        ):
+    '''
+    Like filterstream(), but filter in a pool of 'processes' worker processes.
+    Components, or their text as returned by readcomponents(parse = False),
+    are sent to the workers in chunks of 'chunksize'. Each chunk is filtered
+    with a fresh copy of 'arg', which is passed to merge(arg, chunkarg) in
+    input order, so that memo dicts can be combined. The accepted components
+    are yielded in input order; only rejected top-level components are
+    appended to 'filtered'.
+
+    'f' and 'arg' must be picklable, and 'f' must not depend on the order in
+    which components are filtered.
+    '''
+    import multiprocessing      # only when filtering in parallel
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, filterinit, (f, arg))
+    try:
+        pending = collections.deque()
+        timezones = []
+        texts = []
+        for component in components:
+            if isinstance(component, basestring):
+                text = component
+                if text.startswith('BEGIN:VTIMEZONE'):
+                    parsecomponent(text)    # register the TZID here too
+                    timezones.append(text)
+            else:
+                # Buffers can't be pickled
+                text = str(componenttext(component) or
+                    serializecomponent(component))
+                if component.name == vobject.icalendar.VTimezone.name:
+                    timezones.append(text)
+            texts.append(text)
+            if len(texts) < chunksize:
+                continue
+            pending.append(pool.apply_async(filterchunk,
+                ((list(timezones), texts),)))
+            texts = []
+            if len(pending) > 2 * processes:
+                for c in filterresults(pending.popleft(), arg, filtered,
+                        merge):
+                    yield c
+        if texts:
+            pending.append(pool.apply_async(filterchunk,
+                ((list(timezones), texts),)))
+        while pending:
+            for c in filterresults(pending.popleft(), arg, filtered, merge):
+                yield c
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def filterresults(result, arg, filtered, merge):
+    results, chunkarg = result.get()
+    if merge:
+        merge(arg, chunkarg)
+    for accepted, text in results:
+        component = parsesource(text)
+        if accepted:
+            yield component
+        else:
+            filtered.append(component)
+
+
+def parsecomponent(text):
+    '''Parse the serialized text of a single component.'''
+    # readOne() only transforms the children; a VTIMEZONE must itself be
+    # transformed to register its TZID.
+    return vobject.readOne(text).transformToNative()
+
+
+def serializecomponent(component):
+    '''
+    Serialize a single component as-is; unlike component.serialize(), don't
+    generate implicit UID or DTSTAMP children.
+    '''
+    buf = StringIO.StringIO()
+    vobject.base.defaultSerialize(component, buf, 75)
+    return buf.getvalue()
+
+
+def parsesource(text):
+    '''
+    Parse the serialized text of a single component, which 'text' may also be
+    a buffer over. If all its lines end with CRLF, the component keeps 'text'
+    for componenttext().
+    '''
+    source = text
+    text = str(text)
+    component = parsecomponent(text)
+    if text.count('\n') == text.count('\r\n'):
+        component.sourceText = source
+    return component
+
+
+def componenttext(component):
+    '''
+    Return the text that a component was parsed from with parsesource(), if
+    it hasn't been changed since; otherwise None. The text is equivalent to
+    serializecomponent(component), and can be written instead.
+    '''
+    return getattr(component, 'sourceText', None)
+
+
+def changedcomponent(component):
+    '''
+    Forget the text of a component (see componenttext()) after changing it
+    or its descendants.
+    '''
+    component.sourceText = None
+
+
+def mapfile(f):
+    '''
+    Memory-map a file object for reading with readcomponents(); return 'f'
+    itself if it can't be mapped (such as a pipe or an empty file). The map
+    stays valid after the file is closed.
+    '''
+    try:
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        return f
+
+
+def eventkey(vevent):
+    '''
+    Return a unicode key identifying an event across runs: its UID, followed
+    by its RECURRENCE-ID if it overrides an instance of a recurring event
+    (which shares the UID of the recurring event). An event without a UID
+    (such as with --disable-preserve-uids) is keyed by its eventhash(), which
+    leaves out DTSTAMP and other properties that change between exports.
+    '''
+    uid = vevent.getChildValue('uid')
+    if not uid:
+        return u'sha1:' + eventhash(vevent)
+    if isinstance(uid, str):
+        uid = uid.decode('utf-8')
+    recurrenceid = vevent.getChildValue('recurrence-id')
+    if recurrenceid is None:
+        return uid
+    if not isinstance(recurrenceid, basestring):
+        recurrenceid = canonicaldt(recurrenceid)
+    return u'%s;RECURRENCE-ID=%s' % (uid, recurrenceid)
+
+
+def overriddenuids(components):
+    '''
+    Return the set of UIDs of the recurring events in a stream of components
+    that have an instance overridden by another event (with a RECURRENCE-ID
+    and the same UID). The components may also be given as text; only those
+    that mention RECURRENCE-ID are parsed.
+    '''
+    uids = set()
+    for component in components:
+        if isinstance(component, basestring):
+            if not recurrenceidline.search(component):
+                continue
+            component = parsecomponent(component)
+        if component.name == vobject.icalendar.VEvent.name and \
+                'recurrence-id' in component.contents:
+            uids.add(component.getChildValue('uid'))
+    return uids
+
+recurrenceidline = re.compile(r'^RECURRENCE-ID[;:]', re.I | re.M)
+
+
+def splitseries(vevent,
+        max_instances = 0,
+        max_exdates = 0,
+        ):
+    '''
+    Split a recurring event into consecutive events whose RRULEs have at most
+    'max_instances' instances and which have at most 'max_exdates' EXDATEs
+    each (0 for no limit), with the EXDATEs that fall in their range. The
+    first event keeps the UID; the others get the UID with a '-2', '-3', ...
+    suffix. Excluded instances before the first, between and after the last
+    of these series are dropped. Return the list of events, or None if the
+    event doesn't need to be (or can't be) split.
+
+    The overrides of its instances would keep the UID of the first series,
+    so events with overrides (see overriddenuids()) must not be split.
+    '''
+    if vevent.name != vobject.icalendar.VEvent.name:
+        return None
+    rule = icalutil.recurrence.getrrule(vevent)
+    if not rule or len(vevent.contents['rrule']) > 1:
+        return None
+    for name in ['rdate', 'exrule', 'recurrence-id']:
+        if name in vevent.contents:
+            return None
+    dtstart = vevent.getChildValue('dtstart')
+    if dtstart is None:
+        return None
+    days = icalutil.recurrence.expand(rule, dtstart)
+    if days is None:
+        return None
+    exdates = []
+    for line in vevent.contents.get('exdate', []):
+        exdates.append((line, [(icalutil.recurrence.dayof(value, dtstart)[0],
+            value) for value in line.value]))
+    chunks = icalutil.recurrence.chunks(days,
+        icalutil.recurrence.excludeddays([value
+            for line, values in exdates for day, value in values], dtstart),
+        max_instances = max_instances,
+        max_exdates = max_exdates,
+        )
+    if len(chunks) == 1 and len(chunks[0][0]) == len(days):
+        return None
+    uid = vevent.getChildValue('uid')
+    # Copy the event without its EXDATEs; timezones can't be deep-copied.
+    lines = vevent.contents.pop('exdate', None)
+    try:
+        text = serializecomponent(vevent)
+    finally:
+        if lines:
+            vevent.contents['exdate'] = lines
+    events = []
+    for chunk, excluded in chunks:
+        event = parsecomponent(text)
+        event.dtstart.value = icalutil.recurrence.shift(dtstart,
+            chunk[0] - days[0])
+        if 'dtend' in event.contents:
+            event.dtend.value = icalutil.recurrence.shift(event.dtend.value,
+                chunk[0] - days[0])
+        event.rrule.value = icalutil.recurrence.chunkrule(rule, dtstart,
+            chunk)
+        excluded = set(excluded)
+        for line, values in exdates:
+            values = [value for day, value in values if day in excluded]
+            if values:
+                line = vobject.base.ContentLine.duplicate(line)
+                line.value = values
+                event.add(line)
+        if uid and events:
+            event.uid.value = u'%s-%d' % (uid, len(events) + 1)
+        events.append(event)
+    return events
+
+
+def canonicaldt(value):
+    '''Format a date or datetime value; aware datetimes in UTC.'''
+    if not hasattr(value, 'time'):
+        return value.strftime('%Y%m%d')
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        return (value - value.utcoffset()).strftime('%Y%m%dT%H%M%SZ')
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def eventhash(vevent, include_uid = False):
+    '''
+    Return a hash of the content of an event that is the same for the same
+    event in different exports: DTSTART, DTEND, RRULE, EXDATE, SUMMARY,
+    LOCATION, DESCRIPTION and optionally UID, in a canonical form.
+    '''
+    lines = []
+    for name in ['dtstart', 'dtend']:
+        value = vevent.getChildValue(name)
+        if value is not None:
+            lines.append(u'%s:%s' % (name, canonicaldt(value)))
+    rule = icalutil.recurrence.getrrule(vevent)
+    if rule:
+        lines.append(u'rrule:' + rule.canonical())
+    elif vevent.getChildValue('rrule'):
+        lines.append(u'rrule:' + vevent.getChildValue('rrule').upper())
+    exdates = {}
+    for child in vevent.contents.get('exdate', []):
+        for value in child.value:
+            exdates[canonicaldt(value)] = True
+    exdates = exdates.keys()
+    exdates.sort()
+    if exdates:
+        lines.append(u'exdate:' + u','.join(exdates))
+    names = ['summary', 'location', 'description']
+    if include_uid:
+        names.append('uid')
+    for name in names:
+        value = (vevent.getChildValue(name) or u'').strip()
+        if value:
+            lines.append(u'%s:%s' % (name, value))
+    return hashlib.sha1(u'\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def readcomponents(f, parse = True):
+    '''
+    Read an iCalendar file object and yield the components (VEVENT, VTIMEZONE,
+    ...) of its first VCALENDAR one at a time, without building the whole
+    calendar tree. VCALENDAR properties (VERSION, PRODID, ...) are skipped.
+    If 'parse' is False, yield the text of each component instead.
+
+    A leading UTF-8 byte order mark is skipped. Raise a ParseError for
+    content before the VCALENDAR, BEGIN and END lines that don't match, and
+    a file that ends before the VCALENDAR does (or has none).
+
+    'f' may also be a memory map (see mapfile()); the parsed components then
+    keep buffers over their text in the map instead of copies of it.
+    '''
+    mapped = isinstance(f, mmap.mmap)
+    if mapped:
+        f.seek(0)
+        reader = iter(f.readline, '')
+    else:
+        reader = f
+    lines = []
+    start = 0
+    names = []                  # of the open components, outermost first
+    number = 0
+    for number, line in enumerate(reader, 1):
+        if number == 1 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        if line[:1] in 'BbEe':
+            key = line[:6].upper()
+            if key == 'BEGIN:':
+                name = line[6:].strip().upper()
+                if not names and name != 'VCALENDAR':
+                    raise vobject.base.ParseError('BEGIN:%s outside of a '
+                        'VCALENDAR' % name, number)
+                names.append(name)
+                if len(names) == 2 and mapped:
+                    start = f.tell() - len(line)
+            elif key[:4] == 'END:':
+                name = line[4:].strip().upper()
+                if not names:
+                    raise vobject.base.ParseError('END:%s outside of a '
+                        'VCALENDAR' % name, number)
+                if names[-1] != name:
+                    raise vobject.base.ParseError('END:%s where END:%s was '
+                        'expected' % (name, names[-1]), number)
+                names.pop()
+                if not names:
+                    return              # END:VCALENDAR
+                if len(names) == 1:
+                    if mapped:
+                        text = buffer(f, start, f.tell() - start)
+                    else:
+                        lines.append(line)
+                        text = ''.join(lines)
+                        lines = []
+                    if parse:
+                        yield parsesource(text)
+                    else:
+                        yield str(text)
+                    continue
+        if len(names) >= 2:
+            if not mapped:
+                lines.append(line)
+        elif not names and line.strip():
+            raise vobject.base.ParseError('Content outside of a VCALENDAR',
+                number)
+    if names:
+        raise vobject.base.ParseError('Missing END:%s' % names[-1], number)
+    raise vobject.base.ParseError('No VCALENDAR')
+
+
 def coalesce(vevent, inplace):
     '''
     Coalesce a recurring daily all-day event into a single non-recurring
@@ -57,31 +531,124 @@ def coalesce(vevent, inplace):
     if vevent.getChildValue('exdate'):
         return False                    # exceptions
 
-    rruleValue = vevent.getChildValue('rrule')
-    if not rruleValue:
+    rule = icalutil.recurrence.getrrule(vevent)
+    if not rule:
         return False                    # no recurrence
 
-    rruleparams = dict([kvp.upper().split('=', 1)
-        for kvp in rruleValue.split(';')])
-    if rruleparams.get(u'FREQ') != u'DAILY':
+    if rule.freq != u'DAILY':
         return False
-    if rruleparams.get(u'INTERVAL') != u'1':
+    if rule.interval != 1:
         return False
-    until = rruleparams.get(u'UNTIL')
-    if not until:
+    if rule.until is None or hasattr(rule.until, 'time'):
         return False
 
     if inplace:
         newv = vevent
     else:
-        newv = copy.deepcopy(vevent)
+        # Buffers can't be deep-copied; the copy is changed anyway.
+        source = componenttext(vevent)
+        changedcomponent(vevent)
+        try:
+            newv = copy.deepcopy(vevent)
+        finally:
+            vevent.sourceText = source
 
-    newv.dtend.value = datetime.datetime.strptime(rruleparams.get(u'UNTIL'),
-        '%Y%m%d').date()
+    newv.dtend.value = rule.until
     del newv.rrule
+    changedcomponent(newv)
     return True
 
 
+def spillrun(run, tempdir):
+    '''Write a sorted run of (key, seq, text) to a temporary file.'''
+    import tempfile             # only when spilling
+    f = tempfile.TemporaryFile(dir = tempdir)
+    for key, seq, text in run:
+        f.write('%d %d %d\n' % (key, seq, len(text)))
+        f.write(text)
+    f.seek(0)
+    return f
+
+
+def readrun(f):
+    '''Read back a sorted run written by spillrun().'''
+    while True:
+        header = f.readline()
+        if not header:
+            return
+        key, seq, size = [int(x) for x in header.split()]
+        yield key, seq, f.read(size)
+
+
+def mergeruns(run, runs, parse):
+    try:
+        for key, seq, text in heapq.merge(run, *[readrun(f) for f in runs]):
+            if parse:
+                yield parsesource(text)
+            else:
+                yield str(text)
+    finally:
+        for f in runs:
+            f.close()
+
+
+def sortcomponents(components, key,
+        keys = None,
+        reverse = False,
+        max_memory = 64 * 1024 * 1024,
+        tempdir = None,
+        parse = True,
+        ):
+    '''
+    Sort a stream of components by 'key', an integer function of a component
+    (such as a UTC timestamp). If 'keys' is given, 'key' returns a value of
+    any type instead, and keys(values) converts the list of values of each
+    run to integers at once. The components are consumed immediately; runs
+    of serialized components are sorted in memory and spilled to temporary
+    files whenever they exceed 'max_memory' bytes. Return an iterator that
+    k-way merges the runs, parsing the components back one at a time (or
+    yielding their text, if 'parse' is False).
+
+    Components with equal keys keep their input order. A component's text
+    is taken from componenttext() if it has one (for components read from a
+    memory map, a buffer over the map rather than a copy), and the parsed
+    components keep it in turn.
+    '''
+    runs = []
+    run = []
+    runsize = 0
+    try:
+        for seq, component in enumerate(components):
+            text = componenttext(component) or serializecomponent(component)
+            run.append((key(component), seq, text))
+            runsize += len(text)
+            if runsize >= max_memory:
+                runs.append(spillrun(sortrun(run, keys, reverse), tempdir))
+                run = []
+                runsize = 0
+    except:
+        for f in runs:
+            f.close()
+        raise
+    return mergeruns(sortrun(run, keys, reverse), runs, parse)
+
+
+def sortrun(run, keys, reverse):
+    '''Sort a run of (key, seq, text), converting its keys with 'keys'.'''
+    if keys:
+        column = keys([k for k, seq, text in run])
+    else:
+        column = [k for k, seq, text in run]
+    if reverse:
+        sign = -1
+    else:
+        sign = 1
+    run = [(sign * k, seq, text)
+        for k, (dummy, seq, text) in zip(column, run)]
+    run.sort()
+    return run
+
+
 def createcalendar(components):
     cal = vobject.iCalendar()
     for c in components:
@@ -89,22 +656,358 @@ def createcalendar(components):
     return cal
 
 
+class calendarindex:
+    '''
+    Top-level components of a calendar, indexed by name and by UID as they are
+    added and removed, so that the components of one type can be counted and
+    selected, and components looked up by UID, without scanning the calendar.
+    Iterates over the components in the order they were added; like a
+    VCALENDAR component, it can be passed to splitcal(), itercomponents() and
+    icalutil.google.uploader.uploadcalendar().
+    '''
+
+    name = vobject.icalendar.VCalendar2_0.name
+
+    def __init__(self, components = None):
+        self.order = collections.OrderedDict()
+        self.byname = {}
+        self.byuid = {}
+        self.uids = {}
+        if components is not None:
+            if hasattr(components, 'components'):
+                components = components.components()
+            for c in components:
+                self.add(c)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return self.order.itervalues()
+
+    def __contains__(self, component):
+        return id(component) in self.order
+
+    def components(self):
+        return self.order.itervalues()
+
+    def add(self, component):
+        key = id(component)
+        if key in self.order:
+            return
+        self.order[key] = component
+        if component.name not in self.byname:
+            self.byname[component.name] = collections.OrderedDict()
+        self.byname[component.name][key] = component
+        uid = component.getChildValue('uid')
+        if uid is not None:
+            if uid not in self.byuid:
+                self.byuid[uid] = collections.OrderedDict()
+            self.byuid[uid][key] = component
+            self.uids[key] = uid
+
+    def remove(self, component):
+        key = id(component)
+        del self.order[key]
+        named = self.byname[component.name]
+        del named[key]
+        if not named:
+            del self.byname[component.name]
+        uid = self.uids.pop(key, None)
+        if uid is not None:
+            components = self.byuid[uid]
+            del components[key]
+            if not components:
+                del self.byuid[uid]
+
+    def names(self):
+        '''Return the names of the components in the index.'''
+        return self.byname.keys()
+
+    def count(self, name):
+        '''Return the number of components named 'name'.'''
+        return len(self.byname.get(name, ()))
+
+    def select(self, name):
+        '''Return the list of components named 'name', in order.'''
+        named = self.byname.get(name)
+        if not named:
+            return []
+        return named.values()
+
+    def lookup(self, uid):
+        '''
+        Return the list of components with the UID 'uid' when they were added
+        (a recurring event and its RECURRENCE-ID exceptions share a UID).
+        '''
+        components = self.byuid.get(uid)
+        if not components:
+            return []
+        return components.values()
+
+
+def encodetext(text):
+    '''Return serialized text as UTF-8 bytes.'''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def componenttzids(component):
+    '''
+    Return the TZIDs (except UTC) used by the properties of a component and
+    its subcomponents, as vobject finds them when serializing a calendar.
+    '''
+    tzids = []
+    components = [component]
+    while components:
+        c = components.pop()
+        if c.name == vobject.icalendar.VTimezone.name:
+            continue
+        for child in c.getChildren():
+            if isinstance(child, vobject.base.Component):
+                components.append(child)
+                continue
+            if child.behavior is not None and child.behavior.forceUTC:
+                continue
+            tzid = getattr(child, 'tzid_param', None)
+            if not tzid:
+                value = child.value
+                if type(value) == list:
+                    value = value and value[0]
+                tzid = vobject.icalendar.TimezoneComponent.registerTzinfo(
+                    getattr(value, 'tzinfo', None))
+            if tzid and tzid != u'UTC' and tzid not in tzids:
+                tzids.append(tzid)
+    return tzids
+
+
+def eventtext(vevent):
+    '''
+    Return the text of a VEVENT as vevent.serialize() does, without
+    serializing it if it has a componenttext() and there is nothing for
+    serialize() to add: a UID, a DTSTAMP or the defaults of VALARMs.
+    '''
+    text = componenttext(vevent)
+    if text is None or 'uid' not in vevent.contents or \
+            'dtstamp' not in vevent.contents or list(vevent.components()):
+        text = vevent.serialize()
+    return text
+
+
+class eventrecord(object):
+    '''
+    Compact stand-in for a VEVENT that is only going to be written or
+    reported: its serialized text and the properties that the filter and
+    split steps look at, decoded. A record takes about a tenth of the memory
+    of the component tree; component() parses the event again when the tree
+    is needed.
+
+    The text is the serialized event as it is written (see eventtext())
+    unless given; it may be a buffer over the file the event was read from.
+    '''
+
+    __slots__ = ('uid', 'dtstart', 'dtend', 'rrule', 'exdates', 'summary',
+        'transp', 'tzids', 'text')
+
+    name = vobject.icalendar.VEvent.name
+
+    # Properties decoded in the slot of the same name
+    PROPERTIES = frozenset(['uid', 'dtstart', 'dtend', 'rrule', 'summary',
+        'transp'])
+
+    def __init__(self, vevent,
+            text = None,
+            ):
+        if text is None:
+            text = eventtext(vevent)
+        self.text = encodetext(text)
+        for name in self.PROPERTIES:
+            setattr(self, name, vevent.getChildValue(name))
+        exdates = []
+        for line in vevent.contents.get('exdate', []):
+            exdates.extend(line.value)
+        self.exdates = tuple(exdates)
+        self.tzids = tuple(componenttzids(vevent))
+
+    def getChildValue(self, childName,
+            default = None,
+            ):
+        '''Like Component.getChildValue(), for the decoded properties.'''
+        name = childName.lower()
+        if name not in self.PROPERTIES:
+            raise KeyError(childName)
+        value = getattr(self, name)
+        if value is None:
+            return default
+        return value
+
+    def component(self):
+        '''Parse the event.'''
+        return parsecomponent(str(self.text))
+
+
+class recordlist(list):
+    '''
+    List of components that keeps the VEVENTs appended to it as eventrecords
+    of their text as-is, such as the events removed by a filter.
+    '''
+
+    def append(self, component):
+        if component.name == vobject.icalendar.VEvent.name and \
+                not isinstance(component, eventrecord):
+            component = eventrecord(component,
+                componenttext(component) or serializecomponent(component))
+        list.append(self, component)
+
+
+class splitwriter:
+    '''
+    Write calendar parts of at most 'max_bytes' bytes (unless a single event
+    is larger), streaming each event to the open part as it is added. Each
+    event is serialized at most once (unchanged events are written as they
+    were read; see eventtext()); VTIMEZONEs are written to a part before the
+    first event that uses them. The events of the open part are kept as
+    eventrecords, which are passed to closepartcallback().
+    '''
+
+    footer = 'END:VCALENDAR\r\n'
+
+    def __init__(self, nonevents, max_bytes,
+            openpartcallback,
+            closepartcallback,
+            callbackarg,
+            ):
+        self.nonevents = nonevents
+        self.max_bytes = max_bytes
+        self.openpartcallback = openpartcallback
+        self.closepartcallback = closepartcallback
+        self.callbackarg = callbackarg
+        self.timezones = {}
+        self.f = None
+        self.events = None
+        self.tzids = None
+        self.size = 0
+
+    def timezone(self, tzid):
+        '''Return the serialized VTIMEZONE for a TZID.'''
+        text = self.timezones.get(tzid)
+        if text is None:
+            text = encodetext(vobject.icalendar.TimezoneComponent(
+                tzinfo = vobject.icalendar.getTzid(tzid)).serialize())
+            self.timezones[tzid] = text
+        return text
+
+    def write(self, text):
+        if self.f is not None:
+            self.f.write(text)
+        self.size += len(text)
+
+    def open(self):
+        header = encodetext(createcalendar(self.nonevents).serialize())
+        header = header[:-len(self.footer)]
+        self.tzids = set([c.getChildValue('tzid') for c in self.nonevents
+            if c.name == vobject.icalendar.VTimezone.name])
+        self.events = []
+        self.size = 0
+        if self.openpartcallback:
+            self.f = self.openpartcallback(self.callbackarg)
+        self.write(header)
+
+    def close(self):
+        if self.events is None:
+            return
+        self.write(self.footer)
+        if self.closepartcallback:
+            self.closepartcallback(self.f, self.events, self.size,
+                self.callbackarg)
+        self.f = None
+        self.events = None
+
+    def add(self, vobj):
+        if vobj.name != vobject.icalendar.VEvent.name:
+            self.nonevents.append(vobj)
+            if self.events is not None:
+                if vobj.name == vobject.icalendar.VTimezone.name:
+                    self.tzids.add(vobj.getChildValue('tzid'))
+                self.write(encodetext(vobj.serialize()))
+            return
+        if not isinstance(vobj, eventrecord):
+            vobj = eventrecord(vobj)
+        text = vobj.text
+        tzids = vobj.tzids
+        if self.events:
+            size = self.size + len(text) + len(self.footer)
+            for tzid in tzids:
+                if tzid not in self.tzids:
+                    size += len(self.timezone(tzid))
+            if size > self.max_bytes:
+                self.close()
+        if self.events is None:
+            self.open()
+        for tzid in tzids:
+            if tzid not in self.tzids:
+                self.write(self.timezone(tzid))
+                self.tzids.add(tzid)
+        self.write(text)
+        self.events.append(vobj)
+
+
 def splitcal(cal,
         events_per_calendar = 1,
         splitcallback = None,
         splitcallbackarg = None,
+        max_bytes = 0,
+        openpartcallback = None,
+        closepartcallback = None,
         ):
     '''
     Read an iCalendar file and write its component events as separate calendar
     files in the given directory.
+
+    'cal' may also be a stream of components (as returned by readcomponents()),
+    in which case non-event components are added to every calendar started
+    after they are read.
+
+    If 'max_bytes' is set, split by serialized size instead of by number of
+    events, streaming each part as it fills: openpartcallback(arg) returns a
+    file object for a new part (or None not to write it), and
+    closepartcallback(f, vevents, size, arg) is called when the part is
+    complete, with the eventrecords of its events. 'splitcallback' is not
+    used in this mode.
     '''
-    nonevents = [c for c in cal.components()
-        if c.name != vobject.icalendar.VEvent.name]
+    if hasattr(cal, 'components'):
+        if not isinstance(cal, calendarindex):
+            cal = calendarindex(cal)
+        components = cal.select(vobject.icalendar.VEvent.name)
+        nonevents = []
+        for name in cal.names():
+            if name != vobject.icalendar.VEvent.name:
+                nonevents.extend(cal.select(name))
+        streaming = False
+    else:
+        components = cal
+        nonevents = []
+        streaming = True
+    if max_bytes > 0:
+        writer = splitwriter(nonevents, max_bytes,
+            openpartcallback = openpartcallback,
+            closepartcallback = closepartcallback,
+            callbackarg = splitcallbackarg,
+            )
+        for vobj in components:
+            if streaming or vobj.name == vobject.icalendar.VEvent.name:
+                writer.add(vobj)
+        writer.close()
+        return
     newcal = createcalendar(nonevents)
     newcalevents = 0
     written = 0
-    for vobj in cal.components():
+    for vobj in components:
         if vobj.name != vobject.icalendar.VEvent.name:
+            if streaming:
+                nonevents.append(vobj)
+                newcal.add(vobj)
             continue
         newcal.add(vobj)
         newcalevents += 1
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+
+import atom
+import gdata
+import gdata.calendar
+
+
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+# Members of the gdata element classes that the encoder writes; the others
+# are never set on entries built from a VEVENT.
+MEMBERS = set([
+    'title',
+    'content',
+    'where',
+    'when',
+    'reminder',
+    'recurrence',
+    'transparency',
+    'uid',
+    'batch_id',
+    'batch_operation',
+    'entry',
+    ])
+
+
+def decode(value):
+    '''Decode a member value like gdata does before adding it to the tree.'''
+    if isinstance(value, unicode) or atom.MEMBER_STRING_ENCODING is unicode:
+        return value
+    return value.decode(atom.MEMBER_STRING_ENCODING)
+
+
+def escapetext(text):
+    '''Escape character data exactly like ElementTree; return UTF-8.'''
+    text = decode(text)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text.encode('utf-8', 'xmlcharrefreplace')
+
+
+def escapeattrib(text):
+    '''Escape an attribute value exactly like ElementTree; return UTF-8.'''
+    text = decode(text)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    return text.encode('utf-8', 'xmlcharrefreplace')
+
+
+class elementspec:
+    '''
+    How gdata serializes an element class: its namespace and tag, its XML
+    attributes in lexical order (ElementTree sorts them), and its children
+    in the iteration order of the class's _children, which is the order
+    gdata writes them in. Only children named in MEMBERS are included.
+    '''
+
+    def __init__(self, cls):
+        self.namespace = cls._namespace
+        self.tag = cls._tag
+        self.attributes = sorted(cls._attributes.iteritems())
+        self.enum = None
+        if issubclass(cls, gdata.calendar.UriEnumElement):
+            # Written as the enum_map key of its value, without text.
+            element = cls()
+            self.enum = (element.attrib_name, {})
+            for key, value in element.enum_map.items():
+                self.enum[1].setdefault(value, key)
+        self.children = []
+        for member, childcls in cls._children.itervalues():
+            if member not in MEMBERS:
+                continue
+            if isinstance(childcls, list):
+                self.children.append((member, elementspec(childcls[0]), True))
+            else:
+                self.children.append((member, elementspec(childcls), False))
+        self.templates = {}
+
+    def template(self, prefix):
+        '''Return the start and end tags of the element for a prefix.'''
+        tags = self.templates.get(prefix)
+        if tags is None:
+            name = '%s:%s' % (prefix, self.tag)
+            tags = ('<' + name, '</' + name + '>')
+            self.templates[prefix] = tags
+        return tags
+
+    def write(self, parts, element, prefixes):
+        '''
+        Append the XML of an element to the list 'parts'. Namespace prefixes
+        are numbered in document order, like ElementTree numbers them.
+        '''
+        prefix = prefixes.get(self.namespace)
+        if prefix is None:
+            prefix = prefixes[self.namespace] = 'ns%d' % len(prefixes)
+        start, end = self.template(prefix)
+        parts.append(start)
+        if self.enum is None:
+            for name, member in self.attributes:
+                value = getattr(element, member, None)
+                if value is not None:
+                    parts.append(' %s="%s"' % (name, escapeattrib(value)))
+            text = getattr(element, 'text', None)
+        else:
+            name, keys = self.enum
+            key = keys.get(element.value)
+            if key is not None:
+                parts.append(' %s="%s"' % (name, escapeattrib(key)))
+            text = None
+        mark = len(parts)
+        parts.append('>')
+        if text:
+            parts.append(escapetext(text))
+        for member, spec, many in self.children:
+            value = getattr(element, member, None)
+            if value is None:
+                continue
+            if many:
+                for child in value:
+                    spec.write(parts, child, prefixes)
+            else:
+                spec.write(parts, value, prefixes)
+        if len(parts) == mark + 1:
+            parts[mark] = ' />'
+        else:
+            parts.append(end)
+
+    def tostring(self, element):
+        '''
+        Return the XML document of an element, byte for byte as gdata's
+        ToString() would write it.
+        '''
+        prefixes = {}
+        parts = [XML_DECLARATION]
+        self.write(parts, element, prefixes)
+        declarations = ''.join([' xmlns:%s="%s"' % (prefix,
+                escapeattrib(namespace))
+            for prefix, namespace in sorted([(prefix, namespace)
+                for namespace, prefix in prefixes.iteritems()])])
+        parts.insert(2, declarations)
+        return ''.join(parts)
+
+
+ENTRY = elementspec(gdata.calendar.CalendarEventEntry)
+FEED = elementspec(gdata.calendar.CalendarEventFeed)
+
+
+class element:
+    '''
+    Element of an entry built without gdata: just its members, named like
+    the members of the gdata class (text, value, start_time, reminder, ...).
+    Members that are not set are left out, like gdata leaves out None.
+    '''
+
+    def __init__(self, **members):
+        self.__dict__.update(members)
+
+
+class entry(element):
+    '''
+    Stand-in for gdata.calendar.CalendarEventEntry that writes its XML
+    directly instead of through an ElementTree.
+    '''
+
+    def ToString(self):
+        return ENTRY.tostring(self)
+
+    def __str__(self):
+        return self.ToString()
+
+
+class feed(element):
+    '''Stand-in for a gdata.calendar.CalendarEventFeed batch request.'''
+
+    def __init__(self, **members):
+        self.entry = []
+        element.__init__(self, **members)
+
+    def AddInsert(self, entry,
+            batch_id_string = None,
+            ):
+        if batch_id_string is None:
+            batch_id_string = str(len(self.entry))
+        entry.batch_id = element(text = batch_id_string)
+        entry.batch_operation = element(type = gdata.BATCH_INSERT)
+        self.entry.append(entry)
+
+    def ToString(self):
+        return FEED.tostring(self)
+
+    def __str__(self):
+        return self.ToString()
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import time
+import datetime
+import random
+import resource
+import tempfile
+import subprocess
+
+import pytz
+import vobject
+import atom
+import gdata
+import gdata.calendar
+import icalutil
+import icalutil.google
+import icalutil.googleutil
+import icalutil.journal
+import icalutil.ratelimit
+import icalutil.standin
+
+
+def addmonths(d, months):
+    months += d.month - 1
+    return d.replace(year = d.year + months // 12, month = months % 12 + 1)
+
+
+RECURRENCES = [
+    # FREQ, weight, occurrence of the n-th instance
+    ('DAILY', 2, lambda d, n: d + datetime.timedelta(days = n)),
+    ('WEEKLY', 5, lambda d, n: d + datetime.timedelta(weeks = n)),
+    ('MONTHLY', 2, lambda d, n: addmonths(d, n)),
+    ('YEARLY', 1, lambda d, n: addmonths(d, 12 * n)),
+]
+
+WORDS = ['meeting', 'lunch', 'review', 'call', 'dentist', 'birthday',
+    'standup', 'planning', 'gym', 'dinner', 'project', 'team', 'weekly',
+    'doctor', 'flight', 'school', 'party', 'holiday', 'report', 'demo']
+
+
+def dtline(name, value, tzid):
+    '''Return a date property line; a date-time in 'tzid' if given.'''
+    if tzid:
+        return '%s;TZID=%s:%s' % (name, tzid, value.strftime('%Y%m%dT%H%M%S'))
+    return '%s;VALUE=DATE:%s' % (name, value.strftime('%Y%m%d'))
+
+
+def generate(f,
+        events = 10000,
+        seed = 0,
+        recurring = 0.2,
+        exdates = 8,
+        overrides = 0.1,
+        alarms = 0.1,
+        all_day = 0.3,
+        timezones = None,
+        ):
+    '''
+    Write a synthetic iCalendar file of 'events' events to the file object
+    'f'. The calendar is fully determined by 'seed' and the other arguments:
+    the fraction of recurring events (with up to 'exdates' EXDATEs each), of
+    recurring events with an instance moved a day later by an override (an
+    event with the same UID and a RECURRENCE-ID), of events with a VALARM
+    and of all-day events, and the TZIDs of the timed events, which are
+    spread evenly over them.
+    '''
+    if timezones is None:
+        timezones = ['America/Los_Angeles']
+    r = random.Random(seed)
+    weighted = []
+    for recurrence in RECURRENCES:
+        weighted.extend([recurrence] * recurrence[1])
+    f.write('BEGIN:VCALENDAR\r\n'
+        'VERSION:2.0\r\n'
+        'PRODID:-//icalutil//bench//EN\r\n')
+    for tzid in timezones:
+        f.write(icalutil.encodetext(vobject.icalendar.TimezoneComponent(
+            pytz.timezone(tzid)).serialize()))
+    first = datetime.date(2000, 1, 1).toordinal()
+    last = datetime.date(2010, 12, 31).toordinal()
+    for n in xrange(events):
+        override = None
+        lines = [
+            'BEGIN:VEVENT',
+            'UID:bench-%d@icalutil' % n,
+            'DTSTAMP:20100101T000000Z',
+            'SUMMARY:%s %d' % (' '.join(r.sample(WORDS, 2)).capitalize(), n),
+            ]
+        start = datetime.date.fromordinal(r.randint(first, last))
+        start = start.replace(day = min(start.day, 28))
+        if r.random() < all_day:
+            tzid = None
+            lines.append('DTSTART;VALUE=DATE:%s' % start.strftime('%Y%m%d'))
+            end = start + datetime.timedelta(days = r.choice([1, 1, 1, 2, 3]))
+            lines.append('DTEND;VALUE=DATE:%s' % end.strftime('%Y%m%d'))
+        else:
+            tzid = timezones[n % len(timezones)]
+            start = datetime.datetime.combine(start,
+                datetime.time(r.randint(7, 19), r.choice([0, 15, 30, 45])))
+            end = start + datetime.timedelta(minutes = r.choice([30, 60, 90]))
+            lines.append('DTSTART;TZID=%s:%s' %
+                (tzid, start.strftime('%Y%m%dT%H%M%S')))
+            lines.append('DTEND;TZID=%s:%s' %
+                (tzid, end.strftime('%Y%m%dT%H%M%S')))
+        if r.random() < 0.3:
+            lines.append('LOCATION:Room %d' % r.randint(1, 500))
+        if r.random() < 0.2:
+            lines.append('DESCRIPTION:%s' %
+                ' '.join(r.sample(WORDS, 8)).capitalize())
+        lines.append('TRANSP:OPAQUE')
+        if r.random() < recurring:
+            freq, weight, nth = r.choice(weighted)
+            count = r.randint(2, 200)
+            if freq == 'YEARLY':
+                lines.append('RRULE:FREQ=YEARLY')
+            else:
+                until = nth(start, count)
+                if hasattr(until, 'time'):
+                    until = until.strftime('%Y%m%dT%H%M%SZ')
+                else:
+                    until = until.strftime('%Y%m%d')
+                lines.append('RRULE:FREQ=%s;UNTIL=%s' % (freq, until))
+            excluded = sorted(r.sample(xrange(1, count),
+                min(count - 1, r.randint(0, exdates))))
+            for k in excluded:
+                exdate = nth(start, k)
+                if tzid:
+                    lines.append('EXDATE;TZID=%s:%s' %
+                        (tzid, exdate.strftime('%Y%m%dT%H%M%S')))
+                else:
+                    lines.append('EXDATE;VALUE=DATE:%s' %
+                        exdate.strftime('%Y%m%d'))
+            if r.random() < overrides and len(excluded) < count - 1:
+                k = r.choice([k for k in xrange(1, count)
+                    if k not in excluded])
+                instance = nth(start, k)
+                moved = instance + datetime.timedelta(days = 1)
+                override = [
+                    'BEGIN:VEVENT',
+                    lines[1],                   # UID
+                    lines[2],                   # DTSTAMP
+                    dtline('RECURRENCE-ID', instance, tzid),
+                    lines[3] + ' (moved)',      # SUMMARY
+                    dtline('DTSTART', moved, tzid),
+                    dtline('DTEND', moved + (end - start), tzid),
+                    'TRANSP:OPAQUE',
+                    'END:VEVENT',
+                    ]
+        if r.random() < alarms:
+            lines.extend([
+                'BEGIN:VALARM',
+                'ACTION:DISPLAY',
+                'TRIGGER:-PT%dM' % r.choice([5, 10, 15, 30, 60]),
+                'DESCRIPTION:Reminder',
+                'END:VALARM',
+                ])
+        lines.append('END:VEVENT')
+        if override:
+            lines.extend(override)
+        f.write('\r\n'.join(lines) + '\r\n')
+    f.write('END:VCALENDAR\r\n')
+
+
+class fakeservice:
+    '''
+    Stand-in for gdata.calendar.service.CalendarService that accepts every
+    insert, update and delete without talking to Google. Each call serializes
+    its entry or feed like the real service, then waits 'latency' seconds.
+    Inserted and updated entries come back with a new edit link.
+    '''
+
+    def __init__(self, latency = 0):
+        self.latency = latency
+        self.calls = 0
+        self.links = 0
+        self.token = None
+
+    def call(self, request):
+        request.ToString()
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def ClientLogin(self, username, password,
+            source = None,
+            ):
+        __pychecker__ = 'unusednames=username,password,source'
+        if self.latency:
+            time.sleep(self.latency)
+        self.token = 'bench'
+
+    def GetClientLoginToken(self):
+        return self.token
+
+    def SetClientLoginToken(self, token):
+        self.token = token
+
+    def editlink(self):
+        self.links += 1
+        return atom.Link(
+            rel = 'edit',
+            href = 'https://www.google.com/calendar/feeds/default/private/' \
+                'full/bench%d/%d' % (self.links, int(time.time())),
+            )
+
+    def InsertEvent(self, new_event, insert_uri):
+        __pychecker__ = 'unusednames=insert_uri'
+        self.call(new_event)
+        return gdata.calendar.CalendarEventEntry(link = [self.editlink()])
+
+    def UpdateEvent(self, edit_uri, updated_event):
+        __pychecker__ = 'unusednames=edit_uri'
+        self.call(updated_event)
+        return gdata.calendar.CalendarEventEntry(link = [self.editlink()])
+
+    def DeleteEvent(self, edit_uri):
+        __pychecker__ = 'unusednames=edit_uri'
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return True
+
+    def ExecuteBatch(self, batch_feed, url):
+        __pychecker__ = 'unusednames=url'
+        self.call(batch_feed)
+        response = gdata.calendar.CalendarEventFeed()
+        for entry in batch_feed.entry:
+            response.entry.append(gdata.calendar.CalendarEventEntry(
+                batch_id = gdata.BatchId(text = entry.batch_id.text),
+                batch_status = gdata.BatchStatus(code = '201',
+                    reason = 'Created'),
+                link = [self.editlink()],
+                ))
+        return response
+
+
+def upload(components, opts, encoder,
+        snapshot = None,
+        ):
+    '''
+    Upload (or sync, with a snapshot) the events to fake services; return the
+    failed events and the number of calls to the services.
+    '''
+    services = []
+    def service():
+        services.append(fakeservice(opts['latency']))
+        return services[-1]
+    uploader = icalutil.google.uploader(
+        username = 'bench@example.com',
+        password = 'bench',
+        workers = opts['workers'],
+        ratelimiter = icalutil.ratelimit.ratelimiter(),
+        batch_size = opts['batch_size'],
+        snapshot = snapshot,
+        service = service,
+        encoder = encoder,
+        )
+    failed = uploader.uploadcalendar(
+        ical = components,
+        filteropts = {
+            'filter': icalutil.googleutil.filterentry,
+            'opts': {
+                'reminder_minutes': opts['reminder_minutes'],
+                'force_reminder': opts['force_reminder'],
+            },
+        },
+        )
+    if snapshot is not None:
+        uploader.deleteremoved()
+    return failed, sum([s.calls for s in services])
+
+
+def httpupload(vevents, opts, encoder, keep_alive):
+    '''
+    Upload the events to a stand-in server over HTTP, with a quota error
+    every 100 calls; return the failed events and the server's counts.
+    '''
+    server = icalutil.standin.server(
+        quota_every = 100,
+        )
+    server.start()
+    try:
+        uploader = icalutil.google.uploader(
+            username = 'bench@example.com',
+            password = 'bench',
+            workers = opts['workers'],
+            ratelimiter = icalutil.ratelimit.ratelimiter(
+                quota_backoff = icalutil.ratelimit.backoff(0.01, 0.1),
+                error_backoff = icalutil.ratelimit.backoff(0.01, 0.1),
+                ),
+            batch_size = opts['batch_size'],
+            service = server.service,
+            encoder = encoder,
+            keep_alive = keep_alive,
+            )
+        failed = uploader.uploadcalendar(
+            ical = vevents,
+            eventcallbacks = {
+                'eventexception': icalutil.googleutil.eventexception,
+            },
+            )
+    finally:
+        server.stop()
+    return failed, server.counts
+
+
+# Command line modules, and the modules they must not import when loaded: the
+# gdata stack is only imported when uploading, and the rest on first use.
+STARTUP = [
+    ('icalutil.googleutil', [
+        'gdata',
+        'atom',
+        'icalutil.google',
+        'icalutil.atomxml',
+        'multiprocessing',
+        'tempfile',
+        ]),
+]
+
+STARTUP_CODE = '''
+import sys
+import time
+start = time.time()
+import %s
+print time.time() - start
+print ' '.join([name for name, module in sys.modules.iteritems() if module])
+'''
+
+
+def startup(runs):
+    '''
+    Time the import of the command line modules in fresh interpreters, best
+    of 'runs'. Return the modules that they imported but shouldn't have.
+    '''
+    path = [os.path.dirname(os.path.dirname(os.path.abspath(
+        icalutil.__file__)))]
+    env = os.environ.copy()
+    if env.get('PYTHONPATH'):
+        path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(path)
+    unexpected = []
+    for module, forbidden in STARTUP:
+        best = None
+        for n in xrange(runs):
+            p = subprocess.Popen([sys.executable, '-c', STARTUP_CODE % module],
+                stdout = subprocess.PIPE,
+                env = env,
+                )
+            output = p.communicate()[0]
+            if p.returncode:
+                raise RuntimeError('Importing %s failed' % module)
+            elapsed, modules = output.split('\n', 1)
+            if best is None or float(elapsed) < best:
+                best = float(elapsed)
+        modules = set(modules.split())
+        unexpected.extend(['%s imports %s' % (module, name)
+            for name in forbidden if name in modules])
+        print '%-10s %8d modules %8.3f s   import %s' % ('startup',
+            len(modules), best, module)
+    return unexpected
+
+
+def peakmemory():
+    '''Peak resident set size of this process so far, in KiB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def report(name, events, elapsed):
+    print '%-10s %8d events %9.3f s %10.1f events/s %9d KiB peak' % (name,
+        events, elapsed, events / max(elapsed, 1e-6), peakmemory())
+
+
+def main():
+    opts, args = icalutil.googleutil.getoptions(
+        description = 'Time the icalutil pipeline stages on a synthetic ' \
+            'calendar (or the given iCal file), uploading to a fake Google ' \
+            'Calendar service',
+        config_file = 'icalbench.cnf',
+        config_vars = [
+            'config_file',
+            'max_filesize',
+            'workers',
+            'batch_size',
+            'entry_encoder',
+            'reminder_minutes',
+            'force_reminder',
+
+            'enable_vcal_import_workaround_hack',
+            'start_uid',
+            'select_uids',
+            'preserve_uids',
+            'coalesce_events',
+            'truncate_exdates',
+            'split_exdates',
+            'max_exdates',
+            'max_recurrences',
+            'accept_neverending_recurrences',
+            'accept_empty_summary',
+            'sort_events',
+            'sort_buffer_size',
+            'filter_processes',
+
+            'events',
+            'seed',
+            'recurring',
+            'exdates',
+            'overrides',
+            'alarms',
+            'all_day',
+            'timezones',
+            'latency',
+            'save',
+            'startup_runs',
+            'http_events',
+            ],
+        )
+    if len(args) > 1:
+        print 'Only one file may be benchmarked!'
+        return 1
+    if opts['startup_runs']:
+        unexpected = startup(opts['startup_runs'])
+        if unexpected:
+            for msg in unexpected:
+                print 'Startup: %s' % msg
+            return 1
+    icalutil.googleutil.log = icalutil.googleutil.noop
+
+    filename = None
+    resynced = 0
+    if args:
+        filename = args[0]
+    else:
+        if opts['save']:
+            filename = opts['save']
+            f = open(filename, 'w')
+        else:
+            fd, filename = tempfile.mkstemp(suffix = '.ics')
+            f = os.fdopen(fd, 'w')
+        try:
+            start = time.time()
+            generate(f,
+                events = opts['events'],
+                seed = opts['seed'],
+                recurring = opts['recurring'],
+                exdates = opts['exdates'],
+                overrides = opts['overrides'],
+                alarms = opts['alarms'],
+                all_day = opts['all_day'],
+                timezones = opts['timezones'],
+                )
+            report('generate', opts['events'], time.time() - start)
+        finally:
+            f.close()
+    try:
+        print '%s: %d bytes' % (filename, os.path.getsize(filename))
+
+        start = time.time()
+        f = open(filename)
+        try:
+            components = icalutil.calendarindex(icalutil.readcomponents(
+                icalutil.mapfile(f)))
+        finally:
+            f.close()
+        nevents = components.count(vobject.icalendar.VEvent.name)
+        report('parse', nevents, time.time() - start)
+
+        if opts['sort_events']:
+            start = time.time()
+            f = open(filename)
+            try:
+                for c in icalutil.googleutil.readevents(f, opts)[0]:
+                    pass
+            finally:
+                f.close()
+            report('sort', nevents, time.time() - start)
+
+        start = time.time()
+        filtered = []
+        memo = {
+            'filters': {},
+            'transforms': {},
+        }
+        opts['overridden_uids'] = icalutil.overriddenuids(components)
+        components = icalutil.calendarindex(icalutil.googleutil.filterevents(
+            components, opts, memo, filtered))
+        vevents = components.select(vobject.icalendar.VEvent.name)
+        report('filter', nevents, time.time() - start)
+
+        start = time.time()
+        parts = []
+        icalutil.splitcal(components,
+            max_bytes = opts['max_filesize'],
+            closepartcallback = lambda f, events, size, arg: parts.append(size),
+            )
+        report('split', len(vevents), time.time() - start)
+        print '%-10s %8d parts %10d bytes' % ('', len(parts), sum(parts))
+
+        start = time.time()
+        for vevent in vevents:
+            icalutil.serializecomponent(vevent)
+        report('serialize', len(vevents), time.time() - start)
+
+        encoder = icalutil.google.ENCODERS[opts['entry_encoder']]()
+        start = time.time()
+        for vevent in vevents:
+            encoder.entry(vevent).ToString()
+        report('entries', len(vevents), time.time() - start)
+
+        start = time.time()
+        failed, calls = upload(components, opts, encoder)
+        report('upload', len(vevents) - len(failed), time.time() - start)
+
+        # Sync into an empty snapshot, then sync the unchanged calendar again,
+        # which must not call the service at all
+        fd, snapshotname = tempfile.mkstemp(suffix = '.snapshot')
+        os.close(fd)
+        try:
+            for name in ['sync', 'resync']:
+                snapshot = icalutil.journal.snapshot(snapshotname)
+                try:
+                    start = time.time()
+                    failed, calls = upload(components, opts, encoder,
+                        snapshot = snapshot)
+                    report(name, len(vevents) - len(failed),
+                        time.time() - start)
+                    print '%-10s %8d calls' % ('', calls)
+                    if name == 'resync':
+                        resynced = calls
+                finally:
+                    snapshot.close()
+        finally:
+            os.remove(snapshotname)
+
+        # Over HTTP to a local server: a connection per call, then keep-alive
+        if opts['http_events']:
+            events = vevents[:opts['http_events']]
+            for name, keep_alive in [('http', False), ('keepalive', True)]:
+                start = time.time()
+                failed, counts = httpupload(events, opts, encoder, keep_alive)
+                report(name, len(events) - len(failed), time.time() - start)
+                print '%-10s %8d connections %5d logins %5d quota errors' % (
+                    '', counts.get('connections', 0), counts.get('logins', 0),
+                    counts.get('quota_errors', 0))
+    finally:
+        if not args and not opts['save']:
+            os.remove(filename)
+
+    if resynced:
+        print 'Resync: %d calls for an unchanged calendar' % resynced
+        return 1
+    return 0
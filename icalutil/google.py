@@ -4,12 +4,23 @@
 import time
 import os.path
 import errno
+import sys
+import copy
+import hashlib
+import threading
+import Queue
 
 import vobject
 import gdata.calendar
 import gdata.calendar.service
 import atom
 
+import icalutil
+import icalutil.atomxml
+import icalutil.keepalive
+import icalutil.ratelimit
+import icalutil.tzcache
+
 
 def getdtstr(vevent, attrname):
     '''Return localized formatted time string for DTSTART or DTEND values.'''
@@ -18,12 +29,24 @@ def getdtstr(vevent, attrname):
         dt = vdt.value   # datetime
         if not hasattr(dt, 'tzinfo'):
             raise AttributeError('No timezone information', vevent)
-        return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', dt.utctimetuple())
-    # Date only ("all-day" event)
-    return time.strftime('%Y-%m-%d', vdt.value.timetuple())
+    # Date only ("all-day" event) otherwise
+    return icalutil.tzcache.rfc3339(vdt.value)
 
 
-def createCalendarEventEntry(vevent):
+def geteventvalues(vevent):
+    '''
+    Return the values of the entry for a VEVENT: title, content and where
+    text, the recurrence text of a recurring event or the start_time and
+    end_time of a single one, and the transparency and uid (or None).
+    '''
+    values = {
+        'title': vevent.getChildValue('summary', '').strip(),
+        'content': vevent.getChildValue('description', '').strip(),
+        'where': vevent.getChildValue('location', '').strip(),
+        'recurrence': None,
+        'transparency': vevent.getChildValue('transp') or None,
+        'uid': vevent.getChildValue('uid') or None,
+        }
     if hasattr(vevent, 'rrule'):
         children = [
             vevent.dtstart,
@@ -33,48 +56,57 @@ def createCalendarEventEntry(vevent):
         if hasattr(vevent, 'exdate'):
             children.extend([child for child in vevent.getChildren()
                 if child.name == 'EXDATE'])
+        # 'DTSTART;TZID=America/Los_Angeles:20050603T080000\r\n'
+        # 'DTEND;TZID=America/Los_Angeles:20050603T080000\r\n'
+        # 'RRULE:FREQ=DAILY;INTERVAL=1;UNTIL=20050609T065959Z;WKST=SU\r\n'
+        # 'EXDATE;TZID=America/Los_Angeles:20091204T070000\r\n'
+        # 'EXDATE;TZID=America/Los_Angeles:20091205T070000\r\n'
+        values['recurrence'] = ''.join([child.serialize()
+            for child in children])
+    else:
+        values['start_time'] = getdtstr(vevent, 'dtstart')
+        values['end_time'] = getdtstr(vevent, 'dtend')
+    return values
+
+
+def createCalendarEventEntry(vevent):
+    values = geteventvalues(vevent)
+    if values['recurrence'] is not None:
         recurrence = gdata.calendar.Recurrence(
-            # 'DTSTART;TZID=America/Los_Angeles:20050603T080000\r\n'
-            # 'DTEND;TZID=America/Los_Angeles:20050603T080000\r\n'
-            # 'RRULE:FREQ=DAILY;INTERVAL=1;UNTIL=20050609T065959Z;WKST=SU\r\n'
-            # 'EXDATE;TZID=America/Los_Angeles:20091204T070000\r\n'
-            # 'EXDATE;TZID=America/Los_Angeles:20091205T070000\r\n'
-            text = ''.join([child.serialize() for child in children])
+            text = values['recurrence'],
             )
         when = []
     else:
         recurrence = None
         when = [
             gdata.calendar.When(
-                start_time = getdtstr(vevent, 'dtstart'),
-                end_time = getdtstr(vevent, 'dtend'),
+                start_time = values['start_time'],
+                end_time = values['end_time'],
                 ),
             ]
 
-    transparencyValue = vevent.getChildValue('transp')
-    if transparencyValue:
+    if values['transparency']:
         transparency = gdata.calendar.Transparency()
-        transparency.value = transparencyValue
+        transparency.value = values['transparency']
     else:
-        transparency.value = None
+        transparency = None
 
-    uidValue = vevent.getChildValue('uid')
-    if uidValue:
+    if values['uid']:
         uid = gdata.calendar.UID(
-            value = uidValue,
+            value = values['uid'],
             )
     else:
         uid = None
     return gdata.calendar.CalendarEventEntry(
         title = atom.Title(
-            text = vevent.getChildValue('summary', '').strip()
+            text = values['title'],
             ),
         content = atom.Content(
-            text = vevent.getChildValue('description', '').strip()
+            text = values['content'],
             ),
         where = [
             gdata.calendar.Where(
-                value_string = vevent.getChildValue('location', '').strip()
+                value_string = values['where'],
                 ),
             ],
         recurrence = recurrence,
@@ -84,6 +116,63 @@ def createCalendarEventEntry(vevent):
         )
 
 
+def createDirectEventEntry(vevent):
+    '''
+    Like createCalendarEventEntry(), but return an icalutil.atomxml.entry,
+    which writes the same XML without building gdata and ElementTree trees.
+    '''
+    values = geteventvalues(vevent)
+    element = icalutil.atomxml.element
+    entry = icalutil.atomxml.entry(
+        title = element(text = values['title']),
+        content = element(text = values['content']),
+        where = [element(value_string = values['where'])],
+        when = [],
+        )
+    if values['recurrence'] is not None:
+        entry.recurrence = element(text = values['recurrence'])
+    else:
+        entry.when.append(element(
+            start_time = values['start_time'],
+            end_time = values['end_time'],
+            reminder = [],
+            ))
+    if values['transparency']:
+        entry.transparency = element(value = values['transparency'])
+    if values['uid']:
+        entry.uid = element(value = values['uid'])
+    return entry
+
+
+class gdataencoder:
+    '''Build entries and batch feeds as gdata.calendar objects.'''
+
+    def entry(self, vevent):
+        return createCalendarEventEntry(vevent)
+
+    def feed(self):
+        return gdata.calendar.CalendarEventFeed()
+
+
+class directencoder:
+    '''
+    Build entries and batch feeds that write their XML directly; the requests
+    are identical to gdataencoder's, but much cheaper to build.
+    '''
+
+    def entry(self, vevent):
+        return createDirectEventEntry(vevent)
+
+    def feed(self):
+        return icalutil.atomxml.feed()
+
+
+ENCODERS = {
+    'gdata': gdataencoder,
+    'direct': directencoder,
+}
+
+
 class uploader:
 
     def __init__(self,
@@ -93,6 +182,15 @@ class uploader:
             calendar_id = None,
             dry_run = False,
             fail_dir = None,
+            workers = 1,
+            ratelimiter = None,
+            batch_size = 0,
+            journal = None,
+            dedup = None,
+            snapshot = None,
+            service = None,
+            encoder = None,
+            keep_alive = False,
             ):
         for dirname in [fail_dir]:
             if dirname and not os.path.isdir(dirname):
@@ -109,64 +207,460 @@ class uploader:
         self.source = source
         self.cal = None
         self.upload_uri = '/calendar/feeds/%s/private/full' % calendar_id
+        self.batch_uri = self.upload_uri + '/batch'
         self.fail_dir = fail_dir
         self.dry_run = dry_run
-            
+        self.workers = workers
+        if ratelimiter is None:
+            ratelimiter = icalutil.ratelimit.ratelimiter()
+        self.ratelimiter = ratelimiter
+        self.batch_size = batch_size
+        self.journal = journal
+        self.dedup = dedup
+        # Content hashes of the events being uploaded, shared by all workers
+        self.dedupinflight = set()
+        self.deduplock = threading.Lock()
+        self.snapshot = snapshot
+        self.syncseen = set()
+        if service is None:
+            service = gdata.calendar.service.CalendarService
+        self.service = service
+        if encoder is None:
+            encoder = gdataencoder()
+        self.encoder = encoder
+        self.http_client = None
+        if keep_alive:
+            self.http_client = icalutil.keepalive.httpclient()
+        # The ClientLogin token, shared by the sessions of all workers
+        self.credentials = {}
+        self.loginlock = threading.Lock()
+        self.token = None
+        self.lock = None
+
+    def callback(self, eventcallbacks, name, *args):
+        '''Call an event callback; calls are serialized between workers.'''
+        f = eventcallbacks.get(name)
+        if not f:
+            return False
+        if self.lock is None:
+            f(*args)
+            return True
+        self.lock.acquire()
+        try:
+            f(*args)
+        finally:
+            self.lock.release()
+        return True
+
     def uploadcalendar(self, ical,
             filteropts = None,
             eventcallbacks = None,
             ):
         if eventcallbacks is None:
             eventcallbacks = {}
+        if hasattr(ical, 'components'):
+            components = ical.components()
+        else:
+            components = ical       # stream from icalutil.readcomponents()
+        if self.workers > 1:
+            return self.uploadconcurrent(components,
+                filteropts = filteropts,
+                eventcallbacks = eventcallbacks,
+                )
         failed = []
-        for component in ical.components():
-            if component.name == vobject.icalendar.VEvent.name:
-                try:
-                    if not self.uploadevent(
-                            vevent = component,
-                            filteropts = filteropts,
-                            eventcallbacks = eventcallbacks,
-                            ):
-                        failed.append(component)
-                except gdata.service.RequestError, e:
-                    if eventcallbacks.get('eventfailed'):
-                        eventcallbacks.get('eventfailed')(self, component,
-                            eventcallbacks.get('eventfailedarg'), e)
-                        failed.append(component)
-                        continue
-                    raise
+        for unit in self.uploadunits(components, eventcallbacks):
+            failed.extend(self.uploadunit(unit,
+                filteropts = filteropts,
+                eventcallbacks = eventcallbacks,
+                ))
+        return failed
+
+    def uploadunits(self, components, eventcallbacks):
+        '''
+        Yield the events to upload, grouped into lists of 'batch_size' events
+        if batching. Events already recorded in the journal are skipped, and so
+        are duplicates (see dedupcheck()). When syncing, the keys of all
+        events are collected for deleteremoved().
+        '''
+        batch = []
+        for component in components:
+            if component.name != vobject.icalendar.VEvent.name:
+                continue
+            key = icalutil.eventkey(component)
+            if self.snapshot is not None:
+                self.syncseen.add(key)
+            if self.journal is not None and key in self.journal:
+                self.callback(eventcallbacks, 'eventskipped', self, component,
+                    eventcallbacks.get('eventskippedarg'))
+                continue
+            if self.dedup is not None and self.dedupcheck(component):
+                self.callback(eventcallbacks, 'eventduplicate', self,
+                    component, eventcallbacks.get('eventduplicatearg'))
+                continue
+            if self.batch_size <= 1:
+                yield component
+                continue
+            batch.append(component)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def uploadunit(self, unit,
+            filteropts = None,
+            eventcallbacks = None,
+            ):
+        '''Upload an event or a batch of events; return the failed events.'''
+        if isinstance(unit, list):
+            failed = self.uploadbatch(unit,
+                filteropts = filteropts,
+                eventcallbacks = eventcallbacks,
+                )
+        elif self.uploadcomponent(unit,
+                filteropts = filteropts,
+                eventcallbacks = eventcallbacks,
+                ):
+            failed = []
+        else:
+            failed = [unit]
+        if self.dedup is not None and failed:
+            self.dedupfailed(failed)
         return failed
 
+    def dedupcheck(self, vevent):
+        '''
+        Return True if an event is a duplicate: its content hash is in the
+        dedup index, which includes the events inserted earlier in this run
+        (see recordevent()), or another event with that hash is being
+        uploaded. Otherwise the event is being uploaded from now on, until it
+        is inserted or fails (see dedupfailed()).
+        '''
+        digest = unicode(icalutil.eventhash(vevent))
+        self.deduplock.acquire()
+        try:
+            if digest in self.dedup or digest in self.dedupinflight:
+                return True
+            self.dedupinflight.add(digest)
+            return False
+        finally:
+            self.deduplock.release()
+
+    def dedupfailed(self, vevents):
+        '''
+        Forget events that failed or were filtered, so that their duplicates
+        are uploaded.
+        '''
+        self.deduplock.acquire()
+        try:
+            for vevent in vevents:
+                self.dedupinflight.discard(unicode(icalutil.eventhash(vevent)))
+        finally:
+            self.deduplock.release()
+
+    def uploadconcurrent(self, components,
+            filteropts = None,
+            eventcallbacks = None,
+            ):
+        '''
+        Upload events with 'workers' threads pulling from a bounded queue. Each
+        worker has its own session, but they share the login token, the
+        keep-alive connection pool and the rate limiter (if any). Return the
+        list of failed events.
+        '''
+        queue = Queue.Queue(self.workers * 2)
+        failed = []
+        errors = []
+        self.lock = threading.RLock()
+        threads = [threading.Thread(
+                target = self.uploadworker,
+                args = (queue, failed, errors, filteropts, eventcallbacks),
+                )
+            for i in range(self.workers)]
+        try:
+            for thread in threads:
+                thread.setDaemon(True)
+                thread.start()
+            for unit in self.uploadunits(components, eventcallbacks):
+                if errors:
+                    break
+                queue.put(unit)
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                while thread.isAlive():
+                    thread.join(1)
+            self.lock = None
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return failed
+
+    def uploadworker(self, queue, failed, errors, filteropts, eventcallbacks):
+        # Each worker has its own session; callbacks get the worker, so
+        # logging out only drops the session of that worker.
+        worker = copy.copy(self)
+        worker.cal = None
+        worker.token = None
+        while True:
+            unit = queue.get()
+            if unit is None:
+                return
+            if errors:
+                continue                # drain the queue after a failure
+            try:
+                failed.extend(worker.uploadunit(unit,
+                    filteropts = filteropts,
+                    eventcallbacks = eventcallbacks,
+                    ))
+            except:
+                errors.append(sys.exc_info())
+
+    def uploadcomponent(self, component,
+            filteropts = None,
+            eventcallbacks = None,
+            ):
+        '''
+        Upload an event, reporting failed requests to the 'eventfailed'
+        callback. Return False if the event was filtered or failed.
+        '''
+        if eventcallbacks is None:
+            eventcallbacks = {}
+        try:
+            return self.uploadevent(
+                vevent = component,
+                filteropts = filteropts,
+                eventcallbacks = eventcallbacks,
+                )
+        except gdata.service.RequestError, e:
+            if self.callback(eventcallbacks, 'eventfailed', self, component,
+                    eventcallbacks.get('eventfailedarg'), e):
+                return False
+            raise
+
+    def login(self, eventcallbacks):
+        '''
+        Start a session, unless there is one. Only the first session logs in;
+        the others reuse its token, until logout().
+        '''
+        if self.cal:
+            return
+        self.loginlock.acquire()
+        try:
+            cal = self.service()
+            if self.http_client is not None:
+                cal.http_client = self.http_client
+            token = self.credentials.get('token')
+            if token is None:
+                self.callback(eventcallbacks, 'beforelogin')
+                if not self.dry_run:
+                    cal.ClientLogin(
+                        username = self.username,
+                        password = self.password,
+                        source = self.source,
+                        )
+                    token = cal.GetClientLoginToken()
+                    self.credentials['token'] = token
+            else:
+                cal.SetClientLoginToken(token)
+            self.token = token
+            self.cal = cal
+        finally:
+            self.loginlock.release()
+
+    def logout(self):
+        '''
+        Drop the session and its token (say, once the token has expired), so
+        that the next call logs in again.
+        '''
+        self.loginlock.acquire()
+        try:
+            if self.token is not None and \
+                    self.credentials.get('token') == self.token:
+                del self.credentials['token']
+            self.token = None
+            self.cal = None
+        finally:
+            self.loginlock.release()
+
+    def uploadbatch(self, vevents,
+            filteropts = None,
+            eventcallbacks = None,
+            ):
+        '''
+        Insert events with a single batch request. Entries that the server
+        rejects are reported to the 'eventfailed' callback like failed single
+        inserts; entries missing from an interrupted batch are retried one at
+        a time. When syncing, unchanged events are skipped and changed ones
+        are updated one at a time. Return the list of filtered and failed
+        events. The 'eventexception' callback gets the list of the events in
+        the batch instead of an event, and the 'afterinsert' callback is only
+        called for the entries that the server inserted.
+        '''
+        if eventcallbacks is None:
+            eventcallbacks = {}
+        feed = self.encoder.feed()
+        pending = {}
+        order = []
+        failed = []
+        updates = []
+        for vevent in vevents:
+            entry = self.encoder.entry(vevent)
+            if filteropts and filteropts.get('filter') and \
+                    not filteropts.get('filter')(vevent, entry,
+                        filteropts.get('opts')):
+                failed.append(vevent)
+                continue
+            operation, link, digest = self.syncstate(vevent, entry)
+            if operation is None:
+                self.callback(eventcallbacks, 'eventunchanged', self, vevent,
+                    eventcallbacks.get('eventunchangedarg'))
+                continue
+            if operation == 'update':
+                updates.append(vevent)
+                continue
+            batch_id = str(len(order))
+            feed.AddInsert(entry = entry, batch_id_string = batch_id)
+            pending[batch_id] = (vevent, entry, digest)
+            order.append(batch_id)
+        for vevent in updates:
+            if not self.uploadcomponent(vevent,
+                    filteropts = filteropts,
+                    eventcallbacks = eventcallbacks,
+                    ):
+                failed.append(vevent)
+        if not order:
+            return failed
+        response = None
+        while True:
+            try:
+                self.login(eventcallbacks)
+                for batch_id in order:
+                    vevent, entry, digest = pending[batch_id]
+                    self.callback(eventcallbacks, 'beforeinsert', self,
+                        vevent, entry, eventcallbacks.get('beforeinsertarg'))
+                if not self.dry_run:
+                    self.ratelimiter.acquire()
+                    response = self.cal.ExecuteBatch(feed, self.batch_uri)
+                    self.ratelimiter.succeeded()
+                break
+            except gdata.service.RequestError, e:
+                if eventcallbacks.get('eventexception'):
+                    eventcallbacks.get('eventexception')(self,
+                        [pending[batch_id][0] for batch_id in order],
+                        feed, e)
+                    continue
+                raise
+        if response is None:
+            for batch_id in order:
+                vevent, entry, digest = pending[batch_id]
+                self.callback(eventcallbacks, 'afterinsert', self, vevent,
+                    entry, eventcallbacks.get('afterinsertarg'))
+            return failed
+        for entry in response.entry:
+            if not entry.batch_id or entry.batch_id.text not in pending:
+                continue
+            vevent, sent, digest = pending.pop(entry.batch_id.text)
+            code = int(entry.batch_status.code)
+            if code < 300:
+                self.callback(eventcallbacks, 'afterinsert', self, vevent,
+                    sent, eventcallbacks.get('afterinsertarg'))
+                self.recordevent(vevent, digest, entry)
+                continue
+            e = gdata.service.RequestError({
+                'status': code,
+                'reason': entry.batch_status.reason,
+                'body': entry.batch_status.text,
+                })
+            if not self.callback(eventcallbacks, 'eventfailed', self, vevent,
+                    eventcallbacks.get('eventfailedarg'), e):
+                raise e
+            failed.append(vevent)
+        for batch_id in order:
+            if batch_id in pending:
+                vevent, entry, digest = pending[batch_id]
+                if not self.uploadcomponent(vevent,
+                        filteropts = filteropts,
+                        eventcallbacks = eventcallbacks,
+                        ):
+                    failed.append(vevent)
+        return failed
+
+    def recordevent(self, vevent,
+            digest = None,
+            response = None,
+            ):
+        '''
+        Record an inserted or updated event in the journal, the dedup index and
+        the snapshot, with the digest of its entry and the edit link of the
+        entry in the response.
+        '''
+        key = icalutil.eventkey(vevent)
+        if self.journal is not None:
+            self.journal.add(key)
+        if self.dedup is not None:
+            contenthash = unicode(icalutil.eventhash(vevent))
+            self.deduplock.acquire()
+            try:
+                self.dedup.add(contenthash)
+                self.dedupinflight.discard(contenthash)
+            finally:
+                self.deduplock.release()
+        if self.snapshot is not None and digest is not None:
+            link = None
+            if response is not None:
+                link = response.GetEditLink()
+            if link is not None and link.href:
+                link = unicode(link.href)
+            else:
+                link = u''
+            self.snapshot.set(key, digest, link)
+
     def uploadevent(self, vevent,
             filteropts = None,
             eventcallbacks = None,
             ):
         if eventcallbacks is None:
             eventcallbacks = {}
-        entry = createCalendarEventEntry(vevent)
+        entry = self.encoder.entry(vevent)
         if filteropts and filteropts.get('filter') and \
                 not filteropts.get('filter')(vevent, entry,
                     filteropts.get('opts')):
             return False
+        operation, link, digest = self.syncstate(vevent, entry)
+        if operation is None:
+            self.callback(eventcallbacks, 'eventunchanged', self, vevent,
+                eventcallbacks.get('eventunchangedarg'))
+            return True
+        if operation == 'update':
+            request = lambda: self.cal.UpdateEvent(link, entry)
+        else:
+            request = lambda: self.cal.InsertEvent(entry, self.upload_uri)
+        response = self.send(operation, vevent, entry, request,
+            eventcallbacks)
+        if response is not None:
+            self.recordevent(vevent, digest, response)
+        return True
+
+    def send(self, operation, vevent, entry, request, eventcallbacks):
+        '''
+        Log in and call request() for an insert, update or delete, retrying
+        after errors that the 'eventexception' callback recovers from; the
+        'before<operation>' and 'after<operation>' callbacks are called around
+        it. Return the response, or None when dry running.
+        '''
+        response = None
         try:
             while True:
                 try:
-                    if not self.cal:
-                        if eventcallbacks.get('beforelogin'):
-                            eventcallbacks.get('beforelogin')()
-                        cal = gdata.calendar.service.CalendarService()
-                        if not self.dry_run:
-                            cal.ClientLogin(
-                                username = self.username,
-                                password = self.password,
-                                source = self.source,
-                                )
-                        self.cal = cal
-                    if eventcallbacks.get('beforeinsert'):
-                        eventcallbacks.get('beforeinsert')(self, vevent, entry,
-                            eventcallbacks.get('beforeinsertarg'))
+                    self.login(eventcallbacks)
+                    self.callback(eventcallbacks, 'before' + operation, self,
+                        vevent, entry,
+                        eventcallbacks.get('before%sarg' % operation))
                     if not self.dry_run:
-                        self.cal.InsertEvent(entry, self.upload_uri)
+                        self.ratelimiter.acquire()
+                        response = request()
+                        self.ratelimiter.succeeded()
                     break
                 except gdata.service.RequestError, e:
                     if eventcallbacks.get('eventexception'):
@@ -175,7 +669,55 @@ class uploader:
                         continue
                     raise
         finally:
-            if eventcallbacks.get('afterinsert'):
-                eventcallbacks.get('afterinsert')(self, vevent, entry,
-                    eventcallbacks.get('afterinsertarg'))
-        return True
+            self.callback(eventcallbacks, 'after' + operation, self, vevent,
+                entry, eventcallbacks.get('after%sarg' % operation))
+        return response
+
+    def syncstate(self, vevent, entry):
+        '''
+        Return how to sync an event given its entry: ('insert', None, digest),
+        ('update', edit link, digest), or (None, None, digest) if the entry
+        is unchanged since the snapshot. The digest and the edit link are kept
+        under the event's eventkey(), so that the overrides of a recurring
+        event's instances are synced apart from it. An event without a UID
+        is keyed by its content, so a change to it shows up as a new event
+        and a removed one. Without a snapshot, always insert.
+        '''
+        if self.snapshot is None:
+            return 'insert', None, None
+        key = icalutil.eventkey(vevent)
+        digest = unicode(hashlib.sha1(entry.ToString()).hexdigest())
+        state = self.snapshot.get(key)
+        if state is None:
+            return 'insert', None, digest
+        if state[0] == digest:
+            return None, None, digest
+        if not state[1]:
+            return 'insert', None, digest
+        return 'update', state[1], digest
+
+    def deleteremoved(self,
+            eventcallbacks = None,
+            ):
+        '''
+        Delete the events of the snapshot that were not among the events of
+        this sync, and return how many. The callbacks get the key of the event
+        instead of the event, and None for the entry. Events that are already
+        gone from the calendar count as deleted.
+        '''
+        if eventcallbacks is None:
+            eventcallbacks = {}
+        deleted = 0
+        for key in sorted(set(self.snapshot.keys()) - self.syncseen):
+            digest, link = self.snapshot.get(key)
+            if link:
+                try:
+                    self.send('delete', key, None,
+                        lambda: self.cal.DeleteEvent(link), eventcallbacks)
+                except gdata.service.RequestError, e:
+                    if e.args[0]['status'] not in [404, 410]:
+                        raise
+            if not self.dry_run:
+                self.snapshot.remove(key)
+            deleted += 1
+        return deleted
@@ -7,15 +7,17 @@ import os.path
 import time
 import datetime
 import re
-import pytz
-import calendar
 import copy
 import errno
+import collections
 
 import vobject
-import gdata.calendar
 import icalutil
-import icalutil.google
+import icalutil.recurrence
+import icalutil.tzcache
+import icalutil.ratelimit
+import icalutil.journal
+import icalutil.metrics
 
 
 def getconfigstr(config, fieldname):
@@ -39,6 +41,13 @@ def getconfigint(config, fieldname):
         pass
 
 
+def getconfigfloat(config, fieldname):
+    try:
+        return config.getfloat(ConfigParser.DEFAULTSECT, fieldname)
+    except ConfigParser.NoOptionError:
+        pass
+
+
 def getboolopt(options, config, fieldname):
     val = getattr(options, fieldname)
     if val is not None:
@@ -46,6 +55,20 @@ def getboolopt(options, config, fieldname):
     return getconfigboolean(config, fieldname)
 
 
+def getintopt(options, config, fieldname):
+    val = getattr(options, fieldname)
+    if val is not None:
+        return val
+    return getconfigint(config, fieldname)
+
+
+def getfloatopt(options, config, fieldname):
+    val = getattr(options, fieldname)
+    if val is not None:
+        return val
+    return getconfigfloat(config, fieldname)
+
+
 def filterevent(vobj, opts):
     '''Filter for iCalendar VEVENT components.'''
     if vobj.name == vobject.icalendar.VCalendar2_0.name:
@@ -63,6 +86,7 @@ def filterevent(vobj, opts):
             del opts['start_uid']
         if not opts['preserve_uids'] and hasattr(vobj, 'uid'):
             del vobj.uid
+            icalutil.changedcomponent(vobj)
         if opts['select_uids'] and uid not in opts['select_uids']:
             # Select UIDs
             return False
@@ -71,16 +95,13 @@ def filterevent(vobj, opts):
             # Reject events with empty summary strings.
             filters[uid] = 'empty summary'
             return False
-        rrule = vobj.getChildValue('rrule')
-        if rrule:
+        rule = icalutil.recurrence.getrrule(vobj)
+        if rule:
             # Reject events that run forever (buggy Apple iCal Palm vCal
             # import).
-            rruleparams = dict([kvp.upper().split('=', 1)
-                for kvp in rrule.split(';')])
-            freq = rruleparams[u'FREQ']
-            if u'UNTIL' not in rruleparams and \
-                    freq not in opts['accept_neverending_recurrences']:
-                filters[uid] = 'unending %s recurrence' % freq
+            if rule.until is None and \
+                    rule.freq not in opts['accept_neverending_recurrences']:
+                filters[uid] = 'unending %s recurrence' % rule.freq
                 return False
         if opts['enable_vcal_import_workaround_hack']:
             # All-day events (recurring and non-recurring) in a Palm vCal
@@ -92,6 +113,7 @@ def filterevent(vobj, opts):
                 td = dtend - dtstart
                 if td.days == 2 and td.seconds == 0 and td.microseconds == 0:
                     vobj.dtstart.value = dtstart + datetime.timedelta(days = 1)
+                    icalutil.changedcomponent(vobj)
                     if not transforms.get(uid):
                         transforms[uid] = []
                     transforms[uid].append('vcal-import-workaround')
@@ -113,17 +135,38 @@ def filterevent(vobj, opts):
             if remove:
                 for child in remove:
                     vobj.remove(child)
+                icalutil.changedcomponent(vobj)
                 if not transforms.get(uid):
                     transforms[uid] = []
                 transforms[uid].append('truncated oldest %d exdate(s)' %
                     len(remove))
+        events = None
+        if (opts['split_exdates'] or opts['max_recurrences']) and \
+                uid not in opts['overridden_uids']:
+            # Google Calendar rejects events with too many EXDATEs, and only
+            # shows the first ~720 instances of a recurring event; continue
+            # such events as separate consecutive series. Overrides of their
+            # instances keep the UID, so events with overrides stay whole.
+            events = icalutil.splitseries(vobj,
+                max_instances = opts['max_recurrences'],
+                max_exdates = opts['split_exdates'],
+                )
         if opts['max_exdates']:
-            exdates = [child for child in vobj.getChildren()
-                if child.name == u'EXDATE']
-            if len(exdates) > opts['max_exdates']:
-                filters[uid] = '%d EXDATEs, max=%d' % \
-                    (len(exdates), opts['max_exdates'])
-                return False
+            for event in events or [vobj]:
+                exdates = [child for child in event.getChildren()
+                    if child.name == u'EXDATE']
+                if len(exdates) > opts['max_exdates']:
+                    filters[uid] = '%d EXDATEs, max=%d' % \
+                        (len(exdates), opts['max_exdates'])
+                    return False
+        if events:
+            for n, event in enumerate(events):
+                eventuid = event.getChildValue('uid')
+                if not transforms.get(eventuid):
+                    transforms[eventuid] = []
+                transforms[eventuid].append('series %d/%d' %
+                    (n + 1, len(events)))
+            return events
         return True
     # Discard everything else
     return False
@@ -133,8 +176,30 @@ def noop(*args, **kwargs):
     pass
 
 
+metrics = icalutil.metrics.registry()
+
+# Start times of the API calls in progress, by operation and event
+calls = {}
+
+def callstarted(operation, vevent):
+    calls.setdefault((operation, id(vevent)), time.time())
+
+
+def callfinished(operation, vevent, outcome):
+    '''Count an event and the latency of its API call, if it made one.'''
+    start = calls.pop((operation, id(vevent)), None)
+    if start is not None:
+        metrics.observe('request_seconds', time.time() - start,
+            operation = operation)
+    metrics.inc('events_total', outcome = outcome)
+
+
+def logline(msg):
+    return '%s: %s' % (datetime.datetime.now().strftime('%H:%M:%S'), msg)
+
+
 def log(msg):
-    print '%s: %s' % (datetime.datetime.now().strftime('%H:%M:%S'), msg)
+    print logline(msg)
 
 
 def beforelogin():
@@ -142,25 +207,40 @@ def beforelogin():
 
 
 NEWLINE_RE = re.compile('[\r\n]')
+TZID_RE = re.compile('TZID=[^:;]*:')
 
 def beforeinsert(uploader, vevent, entry, uploadmemo):
-    __pychecker__ = 'unusednames=uploader,vevent,entry'
+    __pychecker__ = 'unusednames=uploader'
+    callstarted('insert', vevent)
+    logevent('Inserting', vevent, entry, uploadmemo)
+
+
+def beforeupdate(uploader, vevent, entry, uploadmemo):
+    __pychecker__ = 'unusednames=uploader'
+    callstarted('update', vevent)
+    logevent('Updating', vevent, entry, uploadmemo)
+
+
+def logevent(verb, vevent, entry, uploadmemo):
     split = NEWLINE_RE.split(entry.title.text, 1)
     if split:
         title = split[0].strip()
     else:
         title = None
     uid = vevent.getChildValue('uid') or 'No UID'
-    msg = 'Inserting %d/%d: %s (%s)' % (uploadmemo['inserts'] + 1,
-        uploadmemo['end'], uid, title)
+    done = uploadmemo['inserts'] + uploadmemo['updates'] + \
+        uploadmemo['unchanged']
+    msg = '%s %d/%s: %s (%s)' % (verb, done + 1, uploadmemo['end'] or '?',
+        uid, title)
     if entry.when:
         msg += ' (%s)' % entry.when[0].start_time
     elif entry.recurrence:
-        msg += ' (%s)' % \
-            ';'.join(
-            ';'.join(entry.recurrence.text.split('\r\n')[
-            0:3:2]).replace('TZID=America/Los_Angeles:', '').
-            split(';')[0:3])
+        dtstart = TZID_RE.sub('', entry.recurrence.text.split('\r\n', 1)[0])
+        rule = icalutil.recurrence.getrrule(vevent)
+        if rule:
+            msg += ' (%s;%s)' % (dtstart, rule.summary())
+        else:
+            msg += ' (%s)' % dtstart
     if uid:
         reasons = uploadmemo['transforms'].get(uid)
         if reasons:
@@ -169,37 +249,112 @@ def beforeinsert(uploader, vevent, entry, uploadmemo):
 
 
 def afterinsert(uploader, vevent, entry, uploadmemo):
-    __pychecker__ = 'unusednames=uploader,vevent,entry'
+    __pychecker__ = 'unusednames=uploader,entry'
+    callfinished('insert', vevent, 'inserted')
     uploadmemo['inserts'] += 1
 
 
+def afterupdate(uploader, vevent, entry, uploadmemo):
+    __pychecker__ = 'unusednames=uploader,entry'
+    callfinished('update', vevent, 'updated')
+    uploadmemo['updates'] += 1
+
+
+def eventunchanged(uploader, vevent, uploadmemo):
+    __pychecker__ = 'unusednames=uploader,vevent'
+    metrics.inc('events_total', outcome = 'unchanged')
+    uploadmemo['unchanged'] += 1
+
+
+def beforedelete(uploader, key, entry, uploadmemo):
+    __pychecker__ = 'unusednames=uploader,entry'
+    callstarted('delete', key)
+    log('Deleting %d: %s' % (uploadmemo['deletes'] + 1, key))
+
+
+def afterdelete(uploader, key, entry, uploadmemo):
+    __pychecker__ = 'unusednames=uploader,entry'
+    callfinished('delete', key, 'deleted')
+    uploadmemo['deletes'] += 1
+
+
+def eventskipped(uploader, vevent, uploadmemo):
+    __pychecker__ = 'unusednames=uploader,vevent'
+    metrics.inc('events_total', outcome = 'skipped')
+    uploadmemo['skips'] += 1
+
+
+def eventduplicate(uploader, vevent, uploadmemo):
+    __pychecker__ = 'unusednames=uploader,vevent'
+    metrics.inc('events_total', outcome = 'duplicate')
+    uploadmemo['duplicates'] += 1
+
+
+def eventdesc(vevent):
+    '''
+    Describe the event of a request for log messages: an event, the list of
+    events of a batch request, or the snapshot key of a deleted event.
+    '''
+    if isinstance(vevent, basestring):
+        return 'key %s' % vevent
+    if isinstance(vevent, list):
+        return 'batch of %d event(s), UIDs: %s' % (len(vevent),
+            ', '.join([vobj.getChildValue('uid') or 'No UID'
+                for vobj in vevent]))
+    return 'UID %s' % (vevent.getChildValue('uid') or 'No UID')
+
+
 def eventexception(uploader, vevent, entry, e):
-    __pychecker__ = 'unusednames=vevent,entry'
+    '''
+    Recover from quota and transient errors. Instead of sleeping here, tell
+    the uploader's rate limiter, which holds back all workers for an
+    exponential backoff with jitter and adapts its rate (AIMD). The session
+    is kept: quota errors don't invalidate the login token, only a 401 does.
+    'vevent' is the list of events for a batch request. Other errors are
+    raised again, after logging the events of the request.
+    '''
+    __pychecker__ = 'unusednames=entry'
     eargs = e.args[0]
+    ratelimiter = uploader.ratelimiter
     if eargs['status'] == 403 and \
             eargs['reason'] == 'Forbidden' and \
             eargs['body'] == 'The user has exceeded their quota, and cannot ' \
                 'currently perform this operation':
-        uploader.cal = None
-        log(e)
-        log('Sleeping for 5 minutes')
-        time.sleep(5 * 60)
-        return
-    if eargs['status'] == 302:
         log(e)
-        log('Sleeping for 5 seconds')
-        time.sleep(5)
+        delay = ratelimiter.throttled()
+        log('Backing off for %d second(s)%s' % (delay, ratedesc(ratelimiter)))
+        metrics.inc('retries_total', status = eargs['status'])
+        metrics.inc('backoff_seconds_total', delay, reason = 'quota')
         return
-    if eargs['status'] == 500 and \
+    if eargs['status'] == 302 or \
+            eargs['status'] == 500 and \
             eargs['reason'] == 'Internal Server Error' and \
             eargs['body'] == 'Service error: could not insert entry':
         log(e)
-        log('Sleeping for 5 seconds')
-        time.sleep(5)
+        delay = ratelimiter.failed()
+        log('Backing off for %d second(s)' % delay)
+        metrics.inc('retries_total', status = eargs['status'])
+        metrics.inc('backoff_seconds_total', delay, reason = 'error')
         return
+    if eargs['status'] == 401:
+        # The token has expired: log in again
+        log(e)
+        uploader.logout()
+        delay = ratelimiter.failed()
+        log('Backing off for %d second(s)' % delay)
+        metrics.inc('retries_total', status = eargs['status'])
+        metrics.inc('backoff_seconds_total', delay, reason = 'login')
+        return
+    log('Request failed for %s: %s' % (eventdesc(vevent), e))
     raise e
 
 
+def ratedesc(ratelimiter):
+    if hasattr(ratelimiter, 'rate'):
+        return ', rate %.3f call(s)/second' % ratelimiter.rate
+    return ''
+
+
 def eventfailed(uploader, vevent, uploadmemo, e):
     __pychecker__ = 'unusednames=uploader'
     uid = vevent.getChildValue('uid')
@@ -209,6 +364,7 @@ def eventfailed(uploader, vevent, uploadmemo, e):
     else:
         msg = str(e)
     uploadmemo['fails'][uid] = msg
+    metrics.inc('events_total', outcome = 'failed')
     log('Failed UID: %s (%s)' % (uid, msg))
     if eargs['status'] == 400 or \
             eargs['status'] == 409 and eargs['reason'] == 'Conflict':
@@ -225,8 +381,22 @@ def eventfailed(uploader, vevent, uploadmemo, e):
     raise e
 
 
+class stagedencoder:
+    '''Encoder that times the entries it builds as the 'entries' stage.'''
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    def entry(self, vevent):
+        return metrics.call('entries', self.encoder.entry, vevent)
+
+    def feed(self):
+        return self.encoder.feed()
+
+
 def filterentry(vevent, entry, opts):
     '''Filter entries before uploading to Google.'''
+    import gdata.calendar
     if opts and opts['reminder_minutes'] is not None and \
             ('valarm' in vevent.contents or opts['force_reminder']):
         reminder = gdata.calendar.Reminder(
@@ -238,33 +408,137 @@ def filterentry(vevent, entry, opts):
 
 
 def gettz(components):
-    timezones = [c for c in components
-        if c.name == vobject.icalendar.VTimezone.name]
-    if timezones:
-        if len(timezones) > 1:
-            raise AttributeError('Multi-timezone calendars are not supported',
-                timezones)
-        tzid = timezones[0].getChildValue('tzid')
-        if tzid:
-            return pytz.timezone(tzid)
-        return pytz.utc
-    return pytz.utc
-
-
-def componentdt(component, tz):
-    '''Return a timestamp for sorting.'''
+    '''Return a zone registry of the VTIMEZONEs among some components.'''
+    zones = icalutil.tzcache.zoneregistry()
+    for c in components:
+        if c.name == vobject.icalendar.VTimezone.name:
+            zones.add(c)
+    return zones
+
+
+def componentdt(component, zones):
+    '''
+    Return a timestamp for sorting; an all-day DTSTART is in the timezone of
+    its TZID, if any, in the zone registry 'zones'.
+    '''
+    return icalutil.tzcache.epoch(componentdtstart(component),
+        zones.get(componenttzid(component)))
+
+
+def componenttzid(component):
+    '''Return the TZID parameter of the DTSTART of a component, or None.'''
+    dtstart = component.contents.get('dtstart')
+    if dtstart:
+        return dtstart[0].params.get('TZID', [None])[0]
+
+
+def componentdtstart(component):
+    '''Return the DTSTART of a component (or None) for componentdt().'''
     d = component.getChildValue('dtstart')
-    if d is None:
-        tm = datetime.datetime.utcfromtimestamp(0).utctimetuple()
+    if hasattr(d, 'time') and not hasattr(d, 'tzinfo'):
+        raise AttributeError('No timezone information', component)
+    return d
+
+
+def parallelfilter(opts):
+    '''
+    Filter in worker processes? --start-uid depends on the order in which
+    events are filtered, so it always filters serially.
+    '''
+    return opts['filter_processes'] > 1 and not opts['start_uid']
+
+
+def mergememo(filteropts, chunkopts):
+    '''Merge the memo of a chunk filtered in a worker process.'''
+    memo = filteropts['memo']
+    chunkmemo = chunkopts['memo']
+    memo['filters'].update(chunkmemo['filters'])
+    for uid, reasons in chunkmemo['transforms'].iteritems():
+        if not memo['transforms'].get(uid):
+            memo['transforms'][uid] = []
+        memo['transforms'][uid].extend(reasons)
+
+
+def filterevents(components, opts, memo, filtered):
+    '''
+    Filter a stream of components with filterevent(), in worker processes if
+    enabled; removed components are appended to 'filtered'.
+    '''
+    filteropts = copy.copy(opts)
+    filteropts['memo'] = memo
+    if parallelfilter(opts):
+        components = icalutil.filterparallel(components, filterevent,
+            filteropts, filtered,
+            processes = opts['filter_processes'],
+            merge = mergememo,
+            )
     else:
-        if hasattr(d, 'time'):
-            if not hasattr(d, 'tzinfo'):
-                raise AttributeError('No timezone information', component)
-            tm = d.utctimetuple()
-        else:
-            tm = tz.localize(datetime.datetime.combine(d,
-                datetime.time())).utctimetuple()
-    return calendar.timegm(tm)
+        components = icalutil.filterstream(components, filterevent,
+            filteropts, filtered)
+    return metrics.iterate('filter', components)
+
+
+def readevents(f, opts):
+    '''
+    Read the components of an iCalendar file object. Unless sorting is
+    disabled, return the components sorted by descending date (using at most
+    'sort_buffer_size' bytes of memory) and the number of events; otherwise
+    return a stream of the components in file order and None. If filtering in
+    worker processes, the components are returned as text.
+
+    The file is memory-mapped if possible, so that unchanged components can
+    be written from the map as they were read (see icalutil.eventtext()).
+
+    The UIDs of the events with overrides, which filterevent() must not split
+    into series, are set in opts['overridden_uids']. Unless sorting, this
+    takes a first pass over the file (copied to a temporary file first if it
+    can't be mapped, such as a pipe).
+    '''
+    mapped = icalutil.mapfile(f)
+    if not opts['sort_events']:
+        overridden = set()
+        if opts['split_exdates'] or opts['max_recurrences']:
+            if mapped is f:
+                import tempfile     # only for input that can't be mapped
+                import shutil
+                f = tempfile.TemporaryFile()
+                shutil.copyfileobj(mapped, f)
+                f.seek(0)
+                mapped = icalutil.mapfile(f)
+            overridden = icalutil.overriddenuids(
+                icalutil.readcomponents(mapped, parse = False))
+            if mapped is f:
+                f.seek(0)
+        opts['overridden_uids'] = overridden
+        return metrics.iterate('read', icalutil.readcomponents(mapped,
+            parse = not parallelfilter(opts),
+            )), None
+    components = metrics.iterate('read', icalutil.readcomponents(mapped))
+    log('Sorting events by descending date ...')
+    zones = icalutil.tzcache.zoneregistry()
+    counts = {'events': 0}
+    overridden = opts['overridden_uids'] = set()
+    def sortkey(component):
+        if component.name == vobject.icalendar.VEvent.name:
+            counts['events'] += 1
+            if 'recurrence-id' in component.contents:
+                overridden.add(component.getChildValue('uid'))
+        elif component.name == vobject.icalendar.VTimezone.name:
+            zones.add(component)
+        return componentdtstart(component), componenttzid(component)
+    def sortkeys(keys):
+        return icalutil.tzcache.epochcolumn([value for value, tzid in keys],
+            zones = [zones.get(tzid) for value, tzid in keys],
+            )
+    components = metrics.call('sort', icalutil.sortcomponents, components,
+        sortkey,
+        keys = sortkeys,
+        reverse = True,     # Descending dtstart
+        max_memory = opts['sort_buffer_size'],
+        parse = not parallelfilter(opts),
+        )
+    log('Sorted %d events' % counts['events'])
+    return metrics.iterate('sort', components), counts['events']
 
 
 def reportuids(vevents, uids, reasons, verb):
@@ -366,7 +640,8 @@ def getoptions(description, config_file, config_vars):
         p.add_option('-m', '--max-filesize',
             type = 'int',
             dest = 'max_filesize',
-            help = 'Split input file into files of approximate maximum size',
+            help = 'Split input file into files of at most MAX_FILESIZE ' \
+                'bytes (default: %default)',
             )
         config.set(ConfigParser.DEFAULTSECT, 'max_filesize', '524288')
     if 'fail_dir' in config_vars:
@@ -376,6 +651,84 @@ def getoptions(description, config_file, config_vars):
             help = 'Directory to receive not-uploaded .ics files ' \
                 '(default: %default)',
             )
+    if 'workers' in config_vars:
+        p.add_option('-w', '--workers',
+            type = 'int',
+            dest = 'workers',
+            help = 'Number of concurrent upload workers, each with its own ' \
+                'session (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'workers', '1')
+    if 'rate_limiter' in config_vars:
+        p.add_option('--rate-limiter',
+            type = 'choice',
+            choices = ['none', 'tokenbucket', 'aimd'],
+            dest = 'rate_limiter',
+            help = 'API call pacing shared by all workers: none (back off ' \
+                'on errors only), tokenbucket (fixed RATE_LIMIT) or aimd ' \
+                '(adapt from RATE_LIMIT to quota errors) (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'rate_limiter', 'aimd')
+    if 'rate_limit' in config_vars:
+        p.add_option('--rate-limit',
+            type = 'float',
+            dest = 'rate_limit',
+            metavar = 'CALLS_PER_SECOND',
+            help = 'API call rate for the tokenbucket and aimd rate ' \
+                'limiters; the sustained quota is about one call every ten ' \
+                'seconds (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'rate_limit', '0.1')
+    if 'batch_size' in config_vars:
+        p.add_option('-b', '--batch-size',
+            type = 'int',
+            dest = 'batch_size',
+            help = 'Insert events with batch requests of up to BATCH_SIZE ' \
+                'events; 0 to insert one at a time (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'batch_size', '0')
+    if 'entry_encoder' in config_vars:
+        p.add_option('--entry-encoder',
+            type = 'choice',
+            choices = ['direct', 'gdata'],     # icalutil.google.ENCODERS
+            dest = 'entry_encoder',
+            help = 'Build the XML of event entries with gdata objects or ' \
+                'write it directly, which is faster and produces the same ' \
+                'requests (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'entry_encoder', 'direct')
+    if 'keep_alive' in config_vars:
+        p.add_option('--disable-keep-alive',
+            dest = 'keep_alive',
+            action = 'store_false',
+            help = 'Connect for every API call instead of keeping a ' \
+                'persistent connection per worker.',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'keep_alive', 'true')
+    if 'journal' in config_vars:
+        p.add_option('-j', '--journal',
+            dest = 'journal',
+            metavar = 'FILENAME',
+            help = 'Record uploaded events in FILENAME, and skip events ' \
+                'already recorded there (default: %default)',
+            )
+    if 'dedup_index' in config_vars:
+        p.add_option('-D', '--dedup-index',
+            dest = 'dedup_index',
+            metavar = 'FILENAME',
+            help = 'Skip events with the same content (ignoring UIDs) as ' \
+                'events uploaded in this run or recorded in FILENAME, and ' \
+                'record uploaded events there (default: %default)',
+            )
+    if 'sync' in config_vars:
+        p.add_option('-s', '--sync',
+            dest = 'sync',
+            metavar = 'FILENAME',
+            help = 'Sync with the calendar as of the last sync, recorded ' \
+                'in the snapshot FILENAME: only insert new events, update ' \
+                'changed ones and delete the ones that are gone ' \
+                '(default: %default)',
+            )
     if 'reminder_minutes' in config_vars:
         p.add_option('-r', '--reminder-minutes',
             dest = 'reminder_minutes',
@@ -435,6 +788,17 @@ def getoptions(description, config_file, config_vars):
                 'discarding the older ones.',
             )
         config.set(ConfigParser.DEFAULTSECT, 'truncate_exdates', '0')
+    if 'split_exdates' in config_vars:
+        p.add_option('--split-exdates',
+            type = 'int',
+            dest = 'split_exdates',
+            help = 'Split recurring events with more than SPLIT-EXDATES ' \
+                'recurrence exceptions into consecutive recurring events ' \
+                'with at most SPLIT-EXDATES each; Google Calendar rejects ' \
+                'events with about 72 or more. 0 to disable ' \
+                '(default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'split_exdates', '0')
     if 'max_exdates' in config_vars:
         p.add_option('--max-exdates',
             type = 'int',
@@ -442,6 +806,16 @@ def getoptions(description, config_file, config_vars):
             help = 'Accept events with up to MAX-EXDATE recurrence exceptions.',
             )
         config.set(ConfigParser.DEFAULTSECT, 'max_exdates', '72')
+    if 'max_recurrences' in config_vars:
+        p.add_option('--max-recurrences',
+            type = 'int',
+            dest = 'max_recurrences',
+            help = 'Split recurring events with more than MAX-RECURRENCES ' \
+                'instances into several recurring events; Google Calendar ' \
+                'only shows about 720 instances of each. 0 to disable ' \
+                '(default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'max_recurrences', '0')
     if 'accept_neverending_recurrences' in config_vars:
         p.add_option('-N', '--accept-neverending-recurrences',
             dest = 'accept_neverending_recurrences',
@@ -450,6 +824,41 @@ def getoptions(description, config_file, config_vars):
             )
         config.set(ConfigParser.DEFAULTSECT, 'accept_neverending_recurrences',
             'daily,weekly,monthly,yearly')
+    if 'sort_events' in config_vars:
+        p.add_option('--disable-sort',
+            dest = 'sort_events',
+            action = 'store_false',
+            help = 'Don\'t sort events by descending date; stream events in ' \
+                'file order without reading the whole file first.',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'sort_events', 'true')
+    if 'sort_buffer_size' in config_vars:
+        p.add_option('--sort-buffer-size',
+            type = 'int',
+            dest = 'sort_buffer_size',
+            metavar = 'BYTES',
+            help = 'Sort events in runs of up to BYTES serialized bytes, ' \
+                'spilling runs to temporary files (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'sort_buffer_size', '67108864')
+    if 'jobs' in config_vars:
+        p.add_option('-J', '--jobs',
+            type = 'int',
+            dest = 'jobs',
+            help = 'Read, sort and filter up to JOBS files ahead in as many ' \
+                'worker processes, while the current file is processed; ' \
+                'filtering is then done in the job\'s process ' \
+                '(default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'jobs', '1')
+    if 'filter_processes' in config_vars:
+        p.add_option('-P', '--filter-processes',
+            type = 'int',
+            dest = 'filter_processes',
+            help = 'Filter and transform events in FILTER_PROCESSES worker ' \
+                'processes (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'filter_processes', '1')
     if 'accept_empty_summary' in config_vars:
         p.add_option('-S', '--accept-empty-summary',
             action = 'store_true',
@@ -457,6 +866,129 @@ def getoptions(description, config_file, config_vars):
             help = 'Accept events with empty summaries (default: %default)',
             )
         config.set(ConfigParser.DEFAULTSECT, 'accept_empty_summary', 'false')
+    if 'metrics' in config_vars:
+        p.add_option('--metrics',
+            dest = 'metrics',
+            metavar = 'FILENAME',
+            help = 'Write stage times, event and retry counts and API call ' \
+                'latencies to FILENAME at exit (default: %default)',
+            )
+    if 'metrics_format' in config_vars:
+        p.add_option('--metrics-format',
+            type = 'choice',
+            choices = ['json', 'prometheus'],
+            dest = 'metrics_format',
+            help = 'Format of the metrics file: json, or prometheus for the ' \
+                'node exporter\'s textfile collector (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'metrics_format', 'json')
+    if 'profile' in config_vars:
+        p.add_option('--profile',
+            dest = 'profile',
+            metavar = 'DIRECTORY',
+            help = 'Profile each stage with cProfile, writing STAGE.prof ' \
+                'files to DIRECTORY (default: %default)',
+            )
+    if 'events' in config_vars:
+        p.add_option('--events',
+            type = 'int',
+            dest = 'events',
+            help = 'Number of synthetic events to generate (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'events', '10000')
+    if 'seed' in config_vars:
+        p.add_option('--seed',
+            type = 'int',
+            dest = 'seed',
+            help = 'Random seed for the synthetic calendar (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'seed', '0')
+    if 'recurring' in config_vars:
+        p.add_option('--recurring',
+            type = 'float',
+            dest = 'recurring',
+            metavar = 'FRACTION',
+            help = 'Fraction of synthetic events with an RRULE ' \
+                '(default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'recurring', '0.2')
+    if 'exdates' in config_vars:
+        p.add_option('--exdates',
+            type = 'int',
+            dest = 'exdates',
+            help = 'Maximum number of EXDATEs of a synthetic recurring ' \
+                'event (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'exdates', '8')
+    if 'alarms' in config_vars:
+        p.add_option('--alarms',
+            type = 'float',
+            dest = 'alarms',
+            metavar = 'FRACTION',
+            help = 'Fraction of synthetic events with a VALARM ' \
+                '(default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'alarms', '0.1')
+    if 'overrides' in config_vars:
+        p.add_option('--overrides',
+            type = 'float',
+            dest = 'overrides',
+            metavar = 'FRACTION',
+            help = 'Fraction of synthetic recurring events with an instance ' \
+                'moved by an override (RECURRENCE-ID) (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'overrides', '0.1')
+    if 'all_day' in config_vars:
+        p.add_option('--all-day',
+            type = 'float',
+            dest = 'all_day',
+            metavar = 'FRACTION',
+            help = 'Fraction of synthetic all-day events (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'all_day', '0.3')
+    if 'timezones' in config_vars:
+        p.add_option('--timezones',
+            dest = 'timezones',
+            help = 'TZIDs of synthetic timed events (comma-delimited) ' \
+                '(default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'timezones',
+            'America/Los_Angeles')
+    if 'latency' in config_vars:
+        p.add_option('--latency',
+            type = 'float',
+            dest = 'latency',
+            metavar = 'SECONDS',
+            help = 'Latency of each call to the fake Google Calendar ' \
+                'service (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'latency', '0')
+    if 'http_events' in config_vars:
+        p.add_option('--http-events',
+            type = 'int',
+            dest = 'http_events',
+            metavar = 'EVENTS',
+            help = 'Upload the first EVENTS events to a local stand-in ' \
+                'Google Calendar server over HTTP, with and without ' \
+                'keep-alive; 0 to skip (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'http_events', '500')
+    if 'save' in config_vars:
+        p.add_option('--save',
+            dest = 'save',
+            metavar = 'FILENAME',
+            help = 'Save the synthetic calendar as FILENAME ' \
+                '(default: %default)',
+            )
+    if 'startup_runs' in config_vars:
+        p.add_option('--startup-runs',
+            type = 'int',
+            dest = 'startup_runs',
+            metavar = 'RUNS',
+            help = 'Time the import of the command line modules in RUNS ' \
+                'fresh interpreters; 0 to skip (default: %default)',
+            )
+        config.set(ConfigParser.DEFAULTSECT, 'startup_runs', '5')
     p.set_defaults(
         config_file = config_file,
         )
@@ -485,6 +1017,29 @@ def getoptions(description, config_file, config_vars):
             getconfigint(config, 'max_filesize')
     if 'fail_dir' in config_vars:
         opts['fail_dir'] = options.fail_dir or getconfigstr(config, 'fail_dir')
+    if 'workers' in config_vars:
+        opts['workers'] = options.workers or getconfigint(config, 'workers')
+    if 'rate_limiter' in config_vars:
+        opts['rate_limiter'] = options.rate_limiter or \
+            getconfigstr(config, 'rate_limiter')
+    if 'rate_limit' in config_vars:
+        opts['rate_limit'] = options.rate_limit or \
+            getconfigfloat(config, 'rate_limit')
+    if 'batch_size' in config_vars:
+        opts['batch_size'] = options.batch_size or \
+            getconfigint(config, 'batch_size')
+    if 'entry_encoder' in config_vars:
+        opts['entry_encoder'] = options.entry_encoder or \
+            getconfigstr(config, 'entry_encoder')
+    if 'keep_alive' in config_vars:
+        opts['keep_alive'] = getboolopt(options, config, 'keep_alive')
+    if 'journal' in config_vars:
+        opts['journal'] = options.journal or getconfigstr(config, 'journal')
+    if 'dedup_index' in config_vars:
+        opts['dedup_index'] = options.dedup_index or \
+            getconfigstr(config, 'dedup_index')
+    if 'sync' in config_vars:
+        opts['sync'] = options.sync or getconfigstr(config, 'sync')
     if 'reminder_minutes' in config_vars:
         opts['reminder_minutes'] = options.reminder_minutes or \
             getconfigint(config, 'reminder_minutes')
@@ -507,20 +1062,69 @@ def getoptions(description, config_file, config_vars):
     if 'truncate_exdates' in config_vars:
         opts['truncate_exdates'] = options.truncate_exdates or \
             getconfigint(config, 'truncate_exdates')
+    if 'split_exdates' in config_vars:
+        opts['split_exdates'] = options.split_exdates or \
+            getconfigint(config, 'split_exdates')
     if 'max_exdates' in config_vars:
         opts['max_exdates'] = options.max_exdates or \
             getconfigint(config, 'max_exdates')
+    if 'max_recurrences' in config_vars:
+        opts['max_recurrences'] = options.max_recurrences or \
+            getconfigint(config, 'max_recurrences')
     if 'accept_neverending_recurrences' in config_vars:
         opts['accept_neverending_recurrences'] = [x.strip().upper()
             for x in (options.accept_neverending_recurrences or
             getconfigstr(config, 'accept_neverending_recurrences')).split(',')]
+    if 'sort_events' in config_vars:
+        opts['sort_events'] = getboolopt(options, config, 'sort_events')
+    if 'sort_buffer_size' in config_vars:
+        opts['sort_buffer_size'] = options.sort_buffer_size or \
+            getconfigint(config, 'sort_buffer_size')
+    if 'jobs' in config_vars:
+        opts['jobs'] = options.jobs or getconfigint(config, 'jobs')
+    if 'filter_processes' in config_vars:
+        opts['filter_processes'] = options.filter_processes or \
+            getconfigint(config, 'filter_processes')
     if 'accept_empty_summary' in config_vars:
         opts['accept_empty_summary'] = getboolopt(options, config,
             'accept_empty_summary')
+    if 'metrics' in config_vars:
+        opts['metrics'] = options.metrics or getconfigstr(config, 'metrics')
+    if 'metrics_format' in config_vars:
+        opts['metrics_format'] = options.metrics_format or \
+            getconfigstr(config, 'metrics_format')
+    if 'profile' in config_vars:
+        opts['profile'] = options.profile or getconfigstr(config, 'profile')
+    if 'events' in config_vars:
+        opts['events'] = options.events or getconfigint(config, 'events')
+    if 'seed' in config_vars:
+        opts['seed'] = getintopt(options, config, 'seed')
+    if 'recurring' in config_vars:
+        opts['recurring'] = getfloatopt(options, config, 'recurring')
+    if 'exdates' in config_vars:
+        opts['exdates'] = getintopt(options, config, 'exdates')
+    if 'alarms' in config_vars:
+        opts['alarms'] = getfloatopt(options, config, 'alarms')
+    if 'overrides' in config_vars:
+        opts['overrides'] = getfloatopt(options, config, 'overrides')
+    if 'all_day' in config_vars:
+        opts['all_day'] = getfloatopt(options, config, 'all_day')
+    if 'timezones' in config_vars:
+        opts['timezones'] = [x.strip() for x in (options.timezones or
+            getconfigstr(config, 'timezones') or '').split(',') if x.strip()]
+    if 'latency' in config_vars:
+        opts['latency'] = getfloatopt(options, config, 'latency')
+    if 'http_events' in config_vars:
+        opts['http_events'] = getintopt(options, config, 'http_events')
+    if 'save' in config_vars:
+        opts['save'] = options.save or getconfigstr(config, 'save')
+    if 'startup_runs' in config_vars:
+        opts['startup_runs'] = getintopt(options, config, 'startup_runs')
     return opts, args
 
 
-def splitcb(cal, arg):
+def splitopen(arg):
+    '''Open the next split calendar file.'''
     dirname, basename = os.path.split(arg['filename'])
     basenameprefix, basenameext = os.path.splitext(basename)
     newpath = os.path.join(
@@ -528,25 +1132,45 @@ def splitcb(cal, arg):
         basenameprefix + ('-%06d' % arg['splits']) + basenameext,
         )
     arg['splits'] += 1
+    arg['path'] = newpath
     if os.path.exists(newpath):
         raise EnvironmentError(errno.EEXIST, os.strerror(errno.EEXIST), newpath)
-    events = [c for c in cal.components()
-        if c.name == vobject.icalendar.VEvent.name]
+    if arg['dry_run']:
+        return None
+    return open(newpath, 'w')
+
+
+def splitclose(f, events, size, arg):
+    '''Close a split calendar file once it is full.'''
+    if f:
+        f.close()
     splitmemo = arg['splitmemo']
     for event in events:
         uid = event.getChildValue('uid')
         reasons = splitmemo['transforms'].get(uid)
         if uid and reasons:
             log('Transformed UID %s: %s' % (uid, ','.join(reasons)))
-    newsize = 0
-    if not arg['dry_run']:
-        f = open(newpath, 'w')
-        try:
-            f.write(cal.serialize())
-        finally:
-            f.close()
-        newsize = os.path.getsize(newpath)
-    log('Wrote %s: events=%d, bytes=%d' % (newpath, len(events), newsize))
+    log('Wrote %s: events=%d, bytes=%d' % (arg['path'], len(events), size))
+    metrics.inc('split_files_total')
+    metrics.inc('split_events_total', len(events))
+    metrics.inc('split_bytes_total', size)
+
+
+def startmetrics(opts):
+    if opts['profile']:
+        metrics.profile(opts['profile'])
+
+
+def writemetrics(opts):
+    '''Write the metrics and the stage profiles, if requested.'''
+    if opts['metrics']:
+        metrics.write(opts['metrics'],
+            format = opts['metrics_format'],
+            )
+        log('Wrote metrics to %s' % opts['metrics'])
+    if opts['profile']:
+        for filename in metrics.dumpprofiles():
+            log('Wrote profile %s' % filename)
 
 
 def filtersplit():
@@ -565,9 +1189,18 @@ def filtersplit():
             'preserve_uids',
             'coalesce_events',
             'truncate_exdates',
+            'split_exdates',
             'max_exdates',
+            'max_recurrences',
             'accept_neverending_recurrences',
             'accept_empty_summary',
+            'sort_events',
+            'sort_buffer_size',
+            'filter_processes',
+            'jobs',
+            'metrics',
+            'metrics_format',
+            'profile',
             ],
         )
     if not args:
@@ -578,43 +1211,33 @@ def filtersplit():
         global log
         log = noop
 
-    for filename in args:
-        f = open(filename)
-        try:
-            log('Reading %s ...' % filename)
-            ical = vobject.readComponents(f).next()
-            components = [c for c in ical.components()]
-            nevents = len([c for c in components
-                if c.name == vobject.icalendar.VEvent.name])
-            log('Sorting %d events by descending date ...' % nevents)
-            tz = gettz(components)
-            deco = [(componentdt(c, tz), c) for c in components]
-            deco.sort()
-            components = [pair[1] for pair in deco]
-            components.reverse()    # Descending dtstart
-            ical = icalutil.createcalendar(components)
-            components = None
-            deco = None
-        finally:
-            f.close()
+    startmetrics(opts)
+    try:
+        return filtersplitfiles(args, opts)
+    finally:
+        writemetrics(opts)
+
+
+def filtersplitfiles(args, opts):
+    for filename, splits in preparefiles(args, opts, filtersplitfile):
+        if not splits:
+            log('No events!')
+            return 0
+    return 0
+
+
+def filtersplitfile(filename, opts):
+    '''Filter and split a file; return the number of files written.'''
+    f = open(filename)
+    try:
+        log('Reading %s ...' % filename)
+        components = readevents(f, opts)[0]
         splitmemo = {
             'filters': {},
             'transforms': {},
         }
-        filteropts = copy.copy(opts)
-        filteropts['memo'] = splitmemo
-        filtered = icalutil.filtercomponents(ical, filterevent, filteropts)
-        reportuids(filtered, opts['select_uids'], splitmemo['filters'],
-            'Filtered')
-        newnevents = len([c for c in ical.components()
-            if c.name == vobject.icalendar.VEvent.name])
-        if not newnevents:
-            log('No events!')
-            return 0
-        # Reduce filesize by filtered events
-        oldfilesize = os.path.getsize(filename) * newnevents / nevents
-        # Guess number of events in each sub-calendarfile
-        splitevents = nevents * opts['max_filesize'] / oldfilesize
+        filtered = icalutil.recordlist()
+        components = filterevents(components, opts, splitmemo, filtered)
         start = int(time.time())
         arg = {
             'filename': filename,
@@ -623,18 +1246,190 @@ def filtersplit():
             'splitmemo': splitmemo,
         }
         try:
-            icalutil.splitcal(ical,
-                events_per_calendar = splitevents,
-                splitcallback = splitcb,
+            metrics.call('split', icalutil.splitcal, components,
+                max_bytes = opts['max_filesize'],
+                openpartcallback = splitopen,
+                closepartcallback = splitclose,
                 splitcallbackarg = arg,
                 )
         finally:
+            metrics.inc('events_total', len(filtered), outcome = 'filtered')
+            reportuids(filtered, opts['select_uids'], splitmemo['filters'],
+                'Filtered')
             log('Elapsed time: %d second(s)' % (int(time.time()) - start))
+        return arg['splits']
+    finally:
+        f.close()
 
-    return 0
+
+def preparejob(prepare, filename, opts):
+    '''
+    Run prepare(filename, opts) in a preparefiles() worker process; return
+    its log lines, its metrics and its result.
+    '''
+    global log, metrics
+    lines = []
+    if log is not noop:
+        log = lambda msg: lines.append(logline(msg))
+    metrics = icalutil.metrics.registry()
+    value = prepare(filename, opts)
+    return lines, metrics.items(), value
+
+
+def preparefiles(filenames, opts, prepare):
+    '''
+    Yield each filename with the result of prepare(filename, opts), in order.
+    With several jobs, the next 'jobs' files are prepared ahead in as many
+    worker processes while the caller consumes the current one; the log lines
+    and metrics of each file are passed on when its turn comes. The results
+    must be picklable.
+    '''
+    if opts['jobs'] <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            yield filename, prepare(filename, opts)
+        return
+    import multiprocessing      # only when preparing files in parallel
+    jobopts = copy.copy(opts)
+    jobopts['filter_processes'] = 1     # worker processes can't have workers
+    queue = collections.deque(filenames)
+    pending = collections.deque()
+    pool = multiprocessing.Pool(min(opts['jobs'], len(filenames)))
+    def submit():
+        filename = queue.popleft()
+        pending.append((filename, pool.apply_async(preparejob,
+            (prepare, filename, jobopts))))
+    try:
+        while queue and len(pending) < opts['jobs']:
+            submit()
+        while pending:
+            filename, result = pending.popleft()
+            if queue:
+                submit()
+            lines, items, value = metrics.call('prepare', result.get)
+            for line in lines:
+                print line
+            metrics.merge(items)
+            yield filename, value
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def newuploadmemo():
+    return {
+        'inserts': 0,
+        'skips': 0,
+        'duplicates': 0,
+        'updates': 0,
+        'unchanged': 0,
+        'end': None,
+        'fails': {},
+        'filters': {},
+        'transforms': {},
+    }
+
+
+def readupload(f, opts, uploadmemo, filtered):
+    '''
+    Read, sort and filter the components of a file for upload, and return
+    them as a stream; removed components are appended to 'filtered' as the
+    stream is consumed. Unless streaming in file order, the number of events
+    counted by the sort (before filtering) is set in uploadmemo['end'],
+    unless splitting series adds events to it.
+    '''
+    components, nevents = readevents(f, opts)
+    if not opts['split_exdates'] and not opts['max_recurrences']:
+        uploadmemo['end'] = nevents
+    return filterevents(components, opts, uploadmemo, filtered)
+
+
+def componenttext(component):
+    '''Return the text of a component as a string that can be pickled.'''
+    return str(icalutil.componenttext(component) or
+        icalutil.serializecomponent(component))
+
+
+def prepareupload(filename, opts):
+    '''
+    Read, sort and filter a file for upload in a preparefiles() worker
+    process. Its components are written as they are filtered to a calendar
+    file in opts['spool_dir'], which the caller reads back and removes.
+    Return the name of that file, the filtered components as text and the
+    upload memo.
+    '''
+    import tempfile             # only when preparing files in parallel
+    uploadmemo = newuploadmemo()
+    filtered = []
+    fd, spoolname = tempfile.mkstemp(suffix = '.ics', dir = opts['spool_dir'])
+    spool = os.fdopen(fd, 'wb')
+    try:
+        f = open(filename)
+        try:
+            log('Reading %s ...' % filename)
+            spool.write('BEGIN:VCALENDAR\r\n')
+            for component in readupload(f, opts, uploadmemo, filtered):
+                spool.write(componenttext(component))
+            spool.write('END:VCALENDAR\r\n')
+        finally:
+            f.close()
+    finally:
+        spool.close()
+    return spoolname, [componenttext(component)
+        for component in filtered], uploadmemo
+
+
+def uploadfile(uploader, components, uploadmemo, filtered, opts,
+        eventcallbacks):
+    '''Upload the filtered components of a file and report the outcome.'''
+    import gdata.service
+    for name in ['beforeinsert', 'afterinsert', 'beforeupdate', 'afterupdate',
+            'eventunchanged', 'eventfailed', 'eventskipped', 'eventduplicate']:
+        eventcallbacks[name + 'arg'] = uploadmemo
+    failed = []
+    start = int(time.time())
+    try:
+        failed = metrics.call('upload', uploader.uploadcalendar,
+            ical = components,
+            filteropts = {
+                'filter': filterentry,
+                'opts': {
+                    'reminder_minutes': opts['reminder_minutes'],
+                    'force_reminder': opts['force_reminder'],
+                },
+            },
+            eventcallbacks = eventcallbacks,
+            )
+    except gdata.service.CaptchaRequired:
+        domain = opts['username'].split('@', 1)[1]
+        if domain == 'gmail.com':
+            path = 'accounts'
+        else:
+            path = 'a/%s' % domain    # Google Apps
+        log('https://www.google.com/%s/UnlockCaptcha' % path)
+        raise
+    finally:
+        metrics.inc('events_total', len(filtered), outcome = 'filtered')
+        reportuids(filtered, opts['select_uids'], uploadmemo['filters'],
+            'Filtered')
+        reportuids(filtered, None, uploadmemo['transforms'], 'Transformed')
+        for uid in [vevent.getChildValue('uid') for vevent in failed]:
+            log('Failed UID: %s (%s)' % (uid, uploadmemo['fails'][uid]))
+        if uploadmemo['skips']:
+            log('Skipped %d event(s) already in the journal' %
+                uploadmemo['skips'])
+        if uploadmemo['duplicates']:
+            log('Skipped %d duplicate event(s)' % uploadmemo['duplicates'])
+        log('Inserted %d event(s)' % uploadmemo['inserts'])
+        if uploader.snapshot is not None:
+            log('Updated %d event(s), %d unchanged' %
+                (uploadmemo['updates'], uploadmemo['unchanged']))
+        log('Elapsed time: %d second(s)' % (int(time.time()) - start))
 
 
 def upload():
+    # Only uploads need gdata, which takes longer to import than everything
+    # else together; gcalfiltersplit doesn't load it.
+    import icalutil.google
     opts, args = getoptions(
         description = 'Upload iCal .ics files to Google Calendar',
         config_file = 'gcaluploader.cnf',
@@ -646,6 +1441,15 @@ def upload():
             'quiet',
             'dry_run',
             'fail_dir',
+            'workers',
+            'rate_limiter',
+            'rate_limit',
+            'batch_size',
+            'entry_encoder',
+            'keep_alive',
+            'journal',
+            'dedup_index',
+            'sync',
             'reminder_minutes',
             'force_reminder',
 
@@ -655,9 +1459,18 @@ def upload():
             'preserve_uids',
             'coalesce_events',
             'truncate_exdates',
+            'split_exdates',
             'max_exdates',
+            'max_recurrences',
             'accept_neverending_recurrences',
             'accept_empty_summary',
+            'sort_events',
+            'sort_buffer_size',
+            'filter_processes',
+            'jobs',
+            'metrics',
+            'metrics_format',
+            'profile',
             ],
         )
     if not args:
@@ -668,87 +1481,120 @@ def upload():
         global log
         log = noop
 
+    if opts['rate_limiter'] == 'tokenbucket':
+        ratelimiter = icalutil.ratelimit.tokenbucket(opts['rate_limit'])
+    elif opts['rate_limiter'] == 'aimd':
+        ratelimiter = icalutil.ratelimit.aimd(opts['rate_limit'])
+    else:
+        ratelimiter = icalutil.ratelimit.ratelimiter()
+
+    journal = None
+    if opts['journal']:
+        journal = icalutil.journal.journal(opts['journal'])
+        log('Journal %s: %d uploaded event(s)' % (opts['journal'],
+            len(journal)))
+    dedup = None
+    if opts['dedup_index']:
+        dedup = icalutil.journal.journal(opts['dedup_index'])
+        log('Dedup index %s: %d uploaded event(s)' % (opts['dedup_index'],
+            len(dedup)))
+    snapshot = None
+    if opts['sync']:
+        snapshot = icalutil.journal.snapshot(opts['sync'])
+        log('Snapshot %s: %d synced event(s)' % (opts['sync'],
+            len(snapshot)))
+        if not opts['preserve_uids']:
+            log('Without UIDs, events are synced by content: a changed '
+                'event is deleted and inserted again')
+
     uploader = icalutil.google.uploader(
         username = opts['username'],
         password = opts['password'],
         calendar_id = opts['calendar_id'],
         dry_run = opts['dry_run'],
         fail_dir = opts['fail_dir'],
+        workers = opts['workers'],
+        ratelimiter = ratelimiter,
+        batch_size = opts['batch_size'],
+        journal = journal,
+        dedup = dedup,
+        snapshot = snapshot,
+        encoder = stagedencoder(
+            icalutil.google.ENCODERS[opts['entry_encoder']]()),
+        keep_alive = opts['keep_alive'],
         )
 
     eventcallbacks = {}
     eventcallbacks['beforelogin'] = beforelogin
     eventcallbacks['beforeinsert'] = beforeinsert
     eventcallbacks['afterinsert'] = afterinsert
+    eventcallbacks['beforeupdate'] = beforeupdate
+    eventcallbacks['afterupdate'] = afterupdate
+    eventcallbacks['eventunchanged'] = eventunchanged
     eventcallbacks['eventexception'] = eventexception
     eventcallbacks['eventfailed'] = eventfailed
+    eventcallbacks['eventskipped'] = eventskipped
+    eventcallbacks['eventduplicate'] = eventduplicate
 
-    for filename in args:
-        f = open(filename)
-        try:
-            log('Reading %s ...' % filename)
-            ical = vobject.readComponents(f).next()
-            components = [c for c in ical.components()]
-            nevents = len([c for c in components
-                if c.name == vobject.icalendar.VEvent.name])
-            log('Sorting %d events by descending date ...' % nevents)
-            tz = gettz(components)
-            deco = [(componentdt(c, tz), c) for c in components]
-            deco.sort()
-            components = [pair[1] for pair in deco]
-            components.reverse()    # Descending dtstart
-            ical = icalutil.createcalendar(components)
-            components = None
-            deco = None
-        finally:
-            f.close()
-        uploadmemo = {
-            'inserts': 0,
-            'end': nevents,
-            'fails': {},
-            'filters': {},
-            'transforms': {},
-        }
-        eventcallbacks['beforeinsertarg'] = uploadmemo
-        eventcallbacks['afterinsertarg'] = uploadmemo
-        eventcallbacks['eventfailedarg'] = uploadmemo
-        filteropts = copy.copy(opts)
-        filteropts['memo'] = uploadmemo
-        filtered = icalutil.filtercomponents(ical, filterevent, filteropts)
-        reportuids(filtered, opts['select_uids'], uploadmemo['filters'],
-            'Filtered')
-        nevents = len([c for c in ical.components()
-            if c.name == vobject.icalendar.VEvent.name])
-        uploadmemo['end'] = nevents
-        failed = []
-        start = int(time.time())
-        try:
-            failed = uploader.uploadcalendar(
-                ical = ical,
-                filteropts = {
-                    'filter': filterentry,
-                    'opts': {
-                        'reminder_minutes': opts['reminder_minutes'],
-                        'force_reminder': opts['force_reminder'],
-                    },
-                },
-                eventcallbacks = eventcallbacks,
-                )
-        except gdata.service.CaptchaRequired:
-            domain = opts['username'].split('@', 1)[1]
-            if domain == 'gmail.com':
-                path = 'accounts'
+    startmetrics(opts)
+    try:
+        if opts['jobs'] > 1 and len(args) > 1:
+            import tempfile     # only when preparing files in parallel
+            import shutil
+            opts['spool_dir'] = tempfile.mkdtemp(prefix = 'gcaluploader-')
+            try:
+                for filename, prepared in preparefiles(args, opts,
+                        prepareupload):
+                    spoolname, filteredtexts, uploadmemo = prepared
+                    # Parse the filtered components first: they include the
+                    # VTIMEZONEs, which define the TZIDs of the events.
+                    filtered = [icalutil.parsecomponent(text)
+                        for text in filteredtexts]
+                    f = open(spoolname)
+                    try:
+                        components = metrics.iterate('parse',
+                            icalutil.readcomponents(icalutil.mapfile(f)))
+                        uploadfile(uploader, components, uploadmemo,
+                            filtered, opts, eventcallbacks)
+                    finally:
+                        f.close()
+                        os.remove(spoolname)
+            finally:
+                shutil.rmtree(opts['spool_dir'], ignore_errors = True)
+        else:
+            for filename in args:
+                f = open(filename)
+                try:
+                    log('Reading %s ...' % filename)
+                    uploadmemo = newuploadmemo()
+                    filtered = []
+                    components = readupload(f, opts, uploadmemo, filtered)
+                    uploadfile(uploader, components, uploadmemo, filtered,
+                        opts, eventcallbacks)
+                finally:
+                    f.close()
+        if snapshot is not None:
+            if opts['start_uid'] or opts['select_uids']:
+                log('Not deleting events: only some events were synced')
             else:
-                path = 'a/%s' % domain    # Google Apps
-            log('https://www.google.com/%s/UnlockCaptcha' % path)
-            raise
-        finally:
-            reportuids(filtered, opts['select_uids'], uploadmemo['filters'],
-                'Filtered')
-            reportuids(filtered, None, uploadmemo['transforms'], 'Transformed')
-            for uid in [vevent.getChildValue('uid') for vevent in failed]:
-                log('Failed UID: %s (%s)' % (uid, uploadmemo['fails'][uid]))
-            log('Inserted %d event(s)' % uploadmemo['inserts'])
-            log('Elapsed time: %d second(s)' % (int(time.time()) - start))
+                deletememo = {
+                    'deletes': 0,
+                }
+                eventcallbacks['beforedelete'] = beforedelete
+                eventcallbacks['afterdelete'] = afterdelete
+                eventcallbacks['beforedeletearg'] = deletememo
+                eventcallbacks['afterdeletearg'] = deletememo
+                metrics.call('delete', uploader.deleteremoved,
+                    eventcallbacks)
+                log('Deleted %d event(s)' % deletememo['deletes'])
+    finally:
+        if journal:
+            journal.close()
+        if dedup:
+            dedup.close()
+        if snapshot is not None:
+            snapshot.close()
+        metrics.set('ratelimit_slept_seconds', ratelimiter.slept)
+        writemetrics(opts)
 
     return 0
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+
+import os
+import threading
+
+
+class journal:
+    '''
+    Append-only journal of keys (such as the UIDs of uploaded events), kept in
+    a set for O(1) lookups. Appends are flushed and fsync'ed every
+    'sync_every' keys and on close(). Safe to share between threads.
+    '''
+
+    def __init__(self, filename, sync_every = 100):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.keys = set()
+        torn = False
+        if os.path.exists(filename):
+            f = open(filename)
+            try:
+                for line in f:
+                    if not line.endswith('\n'):
+                        torn = True     # interrupted append; ignore it
+                        break
+                    if line != '\n':
+                        self.keys.add(line[:-1].decode('utf-8'))
+            finally:
+                f.close()
+        self.f = open(filename, 'a')
+        if torn:
+            self.f.write('\n')
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.keys:
+                return
+            self.keys.add(key)
+            self.f.write(key.encode('utf-8') + '\n')
+            self.pending += 1
+            if self.pending >= self.sync_every:
+                self.sync()
+        finally:
+            self.lock.release()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if not self.f.closed:
+                self.sync()
+                self.f.close()
+        finally:
+            self.lock.release()
+
+
+def snapshotline(key, digest, link):
+    '''Return the line of a snapshot file; tabs and newlines are escaped.'''
+    return '\t'.join([unicode(field).encode('unicode_escape')
+        for field in [key, digest, link]]) + '\n'
+
+
+class snapshot:
+    '''
+    Per-key state of the uploaded events (the content digest and remote edit
+    link of each event, by unicode key) as of the last sync. Changes are
+    appended to the file like journal entries, flushed and fsync'ed every
+    'sync_every' changes, and the file is rewritten compactly on close().
+    Safe to share between threads.
+    '''
+
+    def __init__(self, filename, sync_every = 100):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.states = {}
+        torn = False
+        if os.path.exists(filename):
+            f = open(filename)
+            try:
+                for line in f:
+                    if not line.endswith('\n'):
+                        torn = True     # interrupted append; ignore it
+                        break
+                    fields = [field.decode('unicode_escape')
+                        for field in line[:-1].split('\t')]
+                    if len(fields) != 3:
+                        continue
+                    key, digest, link = fields
+                    if digest:
+                        self.states[key] = (digest, link)
+                    else:
+                        self.states.pop(key, None)      # deleted
+            finally:
+                f.close()
+        self.f = open(filename, 'a')
+        if torn:
+            self.f.write('\n')
+        self.pending = 0
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, key):
+        '''Return the (digest, edit link) of a key, or None.'''
+        return self.states.get(key)
+
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self.states.keys()
+        finally:
+            self.lock.release()
+
+    def set(self, key, digest, link):
+        self.lock.acquire()
+        try:
+            if self.states.get(key) == (digest, link):
+                return
+            self.states[key] = (digest, link)
+            self.append(key, digest, link)
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            if self.states.pop(key, None) is not None:
+                self.append(key, u'', u'')
+        finally:
+            self.lock.release()
+
+    def append(self, key, digest, link):
+        '''Append a change to the file; called with the lock held.'''
+        self.f.write(snapshotline(key, digest, link))
+        self.changed = True
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f.closed:
+                return
+            self.sync()
+            self.f.close()
+            if self.changed:
+                self.compact()
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        '''Rewrite the file with one line per key, replacing it atomically.'''
+        tmpname = self.filename + '.tmp'
+        f = open(tmpname, 'w')
+        try:
+            for key, (digest, link) in sorted(self.states.iteritems()):
+                f.write(snapshotline(key, digest, link))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpname, self.filename)
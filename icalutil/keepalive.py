@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+
+import socket
+import httplib
+import threading
+
+import atom.http
+
+
+def connect(connection):
+    '''
+    Connect, disabling Nagle's algorithm: httplib sends the headers and the
+    body of a request separately, and on a persistent connection the body
+    would wait for the server's delayed ACK of the headers.
+    '''
+    connection.connect()
+    sock = connection.sock
+    if hasattr(sock, '_sock'):
+        sock = sock._sock           # ssl.SSLSocket
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class httpclient(atom.http.ProxiedHttpClient):
+    '''
+    HTTP client for gdata services that keeps one persistent (HTTP/1.1
+    keep-alive) connection per host and thread, instead of connecting for
+    every request like atom's client. A request on a connection that the
+    server has closed in the meantime is sent again once on a new connection.
+    Safe to share between threads: each thread uses its own connections.
+
+    Connections tunneled through a proxy are not kept.
+    '''
+
+    def __init__(self,
+            headers = None,
+            ):
+        atom.http.ProxiedHttpClient.__init__(self, headers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.resent = 0
+
+    def connections(self):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        return connections
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
+
+    def _prepare_connection(self, url, headers):
+        key = (url.protocol, url.host, url.port)
+        connections = self.connections()
+        connection, response = connections.pop(key, (None, None))
+        if connection is not None and response is not None and \
+                not response.isclosed():
+            # The last response wasn't read to the end; httplib can't send
+            # another request before it is.
+            connection.close()
+            connection = None
+        self.local.key = key
+        self.local.reused = connection is not None and \
+            connection.sock is not None
+        if connection is not None:
+            # After a response with 'Connection: close', httplib connects
+            # again by itself.
+            if self.local.reused:
+                self.count('reused')
+            else:
+                self.count('opened')
+                connect(connection)
+            self.local.connection = connection
+            return connection
+        connection = atom.http.ProxiedHttpClient._prepare_connection(self, url,
+            headers)
+        self.count('opened')
+        if connection.sock is None:
+            # Not tunneled: httplib reconnects by itself if needed
+            connect(connection)
+            self.local.connection = connection
+        else:
+            self.local.connection = None
+        return connection
+
+    def request(self, operation, url,
+            data = None,
+            headers = None,
+            ):
+        try:
+            response = atom.http.ProxiedHttpClient.request(self, operation, url,
+                data = data,
+                headers = headers,
+                )
+        except (httplib.BadStatusLine, socket.error):
+            # An idle connection closed by the server fails on first use. Data
+            # read from a file can't be sent again.
+            connection = getattr(self.local, 'connection', None)
+            if connection is not None:
+                connection.close()
+                self.local.connection = None
+            if not self.local.reused or hasattr(data, 'read'):
+                raise
+            self.count('resent')
+            response = atom.http.ProxiedHttpClient.request(self, operation, url,
+                data = data,
+                headers = headers,
+                )
+        connection = self.local.connection
+        if connection is not None:
+            self.connections()[self.local.key] = (connection, response)
+            self.local.connection = None
+        return response
+
+    def close(self):
+        '''Close the connections of the calling thread.'''
+        for connection, response in self.connections().values():
+            connection.close()
+        self.connections().clear()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+
+import os
+import time
+import threading
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def labelkey(labels):
+    return tuple(sorted([(name, str(value))
+        for name, value in labels.iteritems()]))
+
+
+def prometheusname(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join(['%s="%s"' % (label,
+            value.replace('\\', '\\\\').replace('"', '\\"'))
+        for label, value in labels]))
+
+
+class histogram:
+    '''Cumulative histogram of observed values, like Prometheus keeps it.'''
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+        self.sum += value
+        self.count += 1
+
+
+class registry:
+    '''
+    Counters, gauges, histograms and stage timers of a run. Safe to share
+    between threads.
+
+    Stages nest: time spent in a stage called from another stage (such as
+    the filter pulling events from the sort) is charged to the inner stage
+    only, so the stage times of a thread add up to its elapsed time. If
+    profiling, each stage of the main thread also gets its own cProfile
+    profiler, enabled only while that stage is running.
+    '''
+
+    def __init__(self):
+        self.values = {}        # (name, labels) -> value
+        self.types = {}         # name -> 'counter', 'gauge' or 'histogram'
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.mainthread = threading.current_thread()
+        self.profiles = None
+        self.profile_dir = None
+
+    def profile(self, dirname):
+        '''Profile each stage of the main thread into dirname/STAGE.prof.'''
+        import cProfile
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.profiler = cProfile.Profile
+        self.profiles = {}
+        self.profile_dir = dirname
+
+    def inc(self, name,
+            value = 1,
+            **labels
+            ):
+        '''Add to a counter.'''
+        key = (name, labelkey(labels))
+        self.lock.acquire()
+        try:
+            self.types.setdefault(name, 'counter')
+            self.values[key] = self.values.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def set(self, name, value, **labels):
+        '''Set a gauge.'''
+        self.lock.acquire()
+        try:
+            self.types.setdefault(name, 'gauge')
+            self.values[(name, labelkey(labels))] = value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value,
+            buckets = BUCKETS,
+            **labels
+            ):
+        '''Add a value to a histogram.'''
+        key = (name, labelkey(labels))
+        self.lock.acquire()
+        try:
+            self.types.setdefault(name, 'histogram')
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = histogram(buckets)
+            h.observe(value)
+        finally:
+            self.lock.release()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def switch(self, old, new):
+        '''Move profiling from stage 'old' to stage 'new' (either None).'''
+        if self.profiles is None or \
+                threading.current_thread() is not self.mainthread:
+            return
+        if old is not None:
+            self.profiles[old].disable()
+        if new is not None:
+            if new not in self.profiles:
+                self.profiles[new] = self.profiler()
+            self.profiles[new].enable()
+
+    def enter(self, stage):
+        '''Start timing a stage, pausing the stage it is called from.'''
+        now = time.time()
+        stack = self.stack()
+        old = None
+        if stack:
+            old, since = stack[-1]
+            self.inc('stage_seconds', now - since, stage = old)
+        stack.append([stage, now])
+        self.switch(old, stage)
+
+    def leave(self):
+        '''Stop timing the current stage, resuming the one that called it.'''
+        now = time.time()
+        stack = self.stack()
+        stage, since = stack.pop()
+        self.inc('stage_seconds', now - since, stage = stage)
+        new = None
+        if stack:
+            stack[-1][1] = now
+            new = stack[-1][0]
+        self.switch(stage, new)
+
+    def call(self, stage, f, *args, **kwargs):
+        '''Call f(*args, **kwargs) as a stage.'''
+        self.enter(stage)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.leave()
+
+    def iterate(self, stage, iterable):
+        '''
+        Iterate over 'iterable', timing the production of each item (but not
+        its consumption) as a stage.
+        '''
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            finally:
+                self.leave()
+            yield item
+
+    def items(self):
+        '''Return the sorted (name, type, labels, value) of all metrics.'''
+        self.lock.acquire()
+        try:
+            return [(name, self.types[name], labels, value)
+                for (name, labels), value in sorted(self.values.items())]
+        finally:
+            self.lock.release()
+
+    def merge(self, items):
+        '''
+        Add the items() of another registry, such as one of a worker
+        process, to this one.
+        '''
+        self.lock.acquire()
+        try:
+            for name, kind, labels, value in items:
+                self.types.setdefault(name, kind)
+                key = (name, labels)
+                current = self.values.get(key)
+                if current is None or kind == 'gauge':
+                    self.values[key] = value
+                elif kind == 'histogram':
+                    current.counts = [a + b
+                        for a, b in zip(current.counts, value.counts)]
+                    current.sum += value.sum
+                    current.count += value.count
+                else:
+                    self.values[key] = current + value
+        finally:
+            self.lock.release()
+
+    def tojson(self):
+        '''Return the metrics as a JSON document.'''
+        import json
+        metrics = []
+        for name, kind, labels, value in self.items():
+            metric = {
+                'name': name,
+                'type': kind,
+                'labels': dict(labels),
+            }
+            if kind == 'histogram':
+                metric['buckets'] = zip(value.buckets, value.counts)
+                metric['sum'] = value.sum
+                metric['count'] = value.count
+            else:
+                metric['value'] = value
+            metrics.append(metric)
+        return json.dumps({
+            'time': time.time(),
+            'metrics': metrics,
+            },
+            indent = 1,
+            separators = (',', ': '),
+            sort_keys = True,
+            ) + '\n'
+
+    def toprometheus(self,
+            prefix = 'icalutil_',
+            ):
+        '''Return the metrics in the Prometheus text exposition format.'''
+        lines = []
+        typed = set()
+        for name, kind, labels, value in self.items():
+            name = prefix + name
+            if name not in typed:
+                lines.append('# TYPE %s %s' % (name, kind))
+                typed.add(name)
+            if kind != 'histogram':
+                lines.append('%s %s' % (prometheusname(name, labels), value))
+                continue
+            for bound, count in zip(value.buckets, value.counts):
+                lines.append('%s %d' % (prometheusname(name + '_bucket',
+                    labels + (('le', repr(float(bound))),)), count))
+            lines.append('%s %d' % (prometheusname(name + '_bucket',
+                labels + (('le', '+Inf'),)), value.count))
+            lines.append('%s %s' % (prometheusname(name + '_sum', labels),
+                value.sum))
+            lines.append('%s %d' % (prometheusname(name + '_count', labels),
+                value.count))
+        return ''.join([line + '\n' for line in lines])
+
+    def write(self, filename,
+            format = 'json',
+            ):
+        '''
+        Write the metrics to a file, replacing it atomically so that a
+        Prometheus textfile collector never reads a partial file.
+        '''
+        if format == 'prometheus':
+            text = self.toprometheus()
+        else:
+            text = self.tojson()
+        tempname = filename + '.tmp'
+        f = open(tempname, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        os.rename(tempname, filename)
+
+    def dumpprofiles(self):
+        '''Write the profile of each stage; return the filenames.'''
+        filenames = []
+        for stage, profiler in sorted((self.profiles or {}).items()):
+            filename = os.path.join(self.profile_dir, stage + '.prof')
+            profiler.dump_stats(filename)
+            filenames.append(filename)
+        return filenames
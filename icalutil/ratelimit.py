@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+
+import time
+import random
+import threading
+
+
+class backoff:
+    '''
+    Exponential backoff with jitter: the n-th consecutive delay is drawn from
+    [d/2, d], where d = min(cap, base * 2**n).
+    '''
+
+    def __init__(self, base, cap):
+        self.base = float(base)
+        self.cap = float(cap)
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.cap, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ratelimiter:
+    '''
+    Rate limiter that doesn't pace calls, but holds all callers back after
+    quota (403) or transient (302, 500) errors. Safe to share between threads.
+
+    Callers call acquire() before each API call, then succeeded(), throttled()
+    (quota exceeded) or failed() (transient error) with its outcome.
+    '''
+
+    def __init__(self,
+            quota_backoff = None,
+            error_backoff = None,
+            ):
+        if quota_backoff is None:
+            quota_backoff = backoff(60, 30 * 60)
+        if error_backoff is None:
+            error_backoff = backoff(1, 60)
+        self.quota_backoff = quota_backoff
+        self.error_backoff = error_backoff
+        self.until = 0
+        self.slept = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a call is allowed.'''
+        while True:
+            self.lock.acquire()
+            try:
+                wait = self.reserve(time.time())
+            finally:
+                self.lock.release()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+            self.lock.acquire()
+            try:
+                self.slept += wait
+            finally:
+                self.lock.release()
+
+    def reserve(self, now):
+        '''
+        Return how long to wait before a call is allowed, or take the call
+        and return 0. Called with the lock held.
+        '''
+        return self.until - now
+
+    def succeeded(self):
+        self.lock.acquire()
+        try:
+            self.quota_backoff.reset()
+            self.error_backoff.reset()
+            self.adjust(True)
+        finally:
+            self.lock.release()
+
+    def throttled(self):
+        '''Back off after a quota error; return the delay in seconds.'''
+        self.lock.acquire()
+        try:
+            self.adjust(False)
+            return self.pause(self.quota_backoff.next())
+        finally:
+            self.lock.release()
+
+    def failed(self):
+        '''Back off after a transient error; return the delay in seconds.'''
+        self.lock.acquire()
+        try:
+            return self.pause(self.error_backoff.next())
+        finally:
+            self.lock.release()
+
+    def pause(self, delay):
+        self.until = max(self.until, time.time() + delay)
+        return delay
+
+    def adjust(self, succeeded):
+        '''Adapt the rate to a call's outcome; called with the lock held.'''
+        pass
+
+
+class tokenbucket(ratelimiter):
+    '''
+    Token bucket rate limiter: allow 'rate' calls per second on average, with
+    bursts of up to 'burst' calls.
+    '''
+
+    def __init__(self, rate,
+            burst = 1,
+            quota_backoff = None,
+            error_backoff = None,
+            ):
+        ratelimiter.__init__(self,
+            quota_backoff = quota_backoff,
+            error_backoff = error_backoff,
+            )
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def reserve(self, now):
+        wait = ratelimiter.reserve(self, now)
+        if wait > 0:
+            return wait
+        self.tokens = min(float(self.burst),
+            self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class aimd(tokenbucket):
+    '''
+    Token bucket whose rate is learned from the responses: the rate grows by
+    'increase' calls per second after every successful call, and is multiplied
+    by 'decrease' after every quota error.
+    '''
+
+    def __init__(self, rate,
+            burst = 1,
+            min_rate = 0.01,
+            max_rate = None,
+            increase = 0.01,
+            decrease = 0.5,
+            quota_backoff = None,
+            error_backoff = None,
+            ):
+        tokenbucket.__init__(self, rate,
+            burst = burst,
+            quota_backoff = quota_backoff,
+            error_backoff = error_backoff,
+            )
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def adjust(self, succeeded):
+        if succeeded:
+            self.rate += self.increase
+            if self.max_rate:
+                self.rate = min(self.rate, self.max_rate)
+        else:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
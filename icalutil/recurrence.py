@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+
+import array
+import datetime
+import threading
+import warnings
+
+import pytz
+
+
+class rrule:
+    '''
+    Compiled RRULE value, with typed FREQ, INTERVAL, UNTIL, COUNT, WKST and
+    BYxxx fields (None when not given). Instances are shared between all the
+    events with the same rule text, so they must not be modified.
+    '''
+
+    INTEGER_PARTS = ['BYSECOND', 'BYMINUTE', 'BYHOUR', 'BYMONTHDAY',
+        'BYYEARDAY', 'BYWEEKNO', 'BYMONTH', 'BYSETPOS']
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        self.params = {}
+        for kvp in text.split(';'):
+            kvp = kvp.strip().upper()
+            if not kvp:
+                continue
+            key, value = kvp.split('=', 1)
+            self.parts.append(kvp)
+            self.params[key] = value
+        self.freq = self.params.get(u'FREQ')
+        self.interval = self.getint(u'INTERVAL')
+        self.count = self.getint(u'COUNT')
+        self.until = self.params.get(u'UNTIL')
+        if self.until is not None:
+            self.until = parseuntil(self.until)
+        self.wkst = self.params.get(u'WKST')
+        self.byday = self.getlist(u'BYDAY')
+        for key in self.INTEGER_PARTS:
+            values = self.getlist(key)
+            if values is not None:
+                values = [int(value) for value in values]
+            setattr(self, key.lower(), values)
+
+    def getint(self, key):
+        value = self.params.get(key)
+        if value is not None:
+            return int(value)
+
+    def getlist(self, key):
+        value = self.params.get(key)
+        if value is not None:
+            return value.split(',')
+
+    def canonical(self):
+        '''Return the rule parts in a canonical (sorted) form.'''
+        parts = list(self.parts)
+        parts.sort()
+        return u';'.join(parts)
+
+    def summary(self):
+        '''Return a short description of the rule for log messages.'''
+        return u'RRULE:FREQ=%s' % self.freq
+
+
+def parseuntil(value):
+    '''
+    Parse an UNTIL value: a date, a UTC datetime or a floating (naive)
+    datetime.
+    '''
+    if 'T' not in value:
+        return datetime.datetime.strptime(value, '%Y%m%d').date()
+    if value.endswith('Z'):
+        return pytz.utc.localize(datetime.datetime.strptime(value,
+            '%Y%m%dT%H%M%SZ'))
+    return datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+
+
+rules = {}
+ruleslock = threading.Lock()
+MAX_RULES = 65536
+
+
+def compile(text):
+    '''
+    Return the compiled rrule for an RRULE value. Identical rule texts share
+    a single compiled rule.
+    '''
+    rule = rules.get(text)
+    if rule is None:
+        rule = rrule(text)
+        ruleslock.acquire()
+        try:
+            if len(rules) >= MAX_RULES:
+                rules.clear()
+            rule = rules.setdefault(text, rule)
+        finally:
+            ruleslock.release()
+    return rule
+
+
+def getrrule(vevent):
+    '''
+    Return the compiled RRULE of an event, or None if it doesn't recur. The
+    rule is cached on the RRULE content line, so the text is only parsed
+    again after it changes.
+
+    A malformed rule (such as an UNTIL that isn't a date or an integer part
+    that isn't a number) is left uncompiled with a warning, and None is
+    returned; the event is passed on as it is.
+    '''
+    lines = vevent.contents.get('rrule')
+    if not lines or not lines[0].value:
+        return None
+    line = lines[0]
+    rule = getattr(line, 'compiled', None)
+    if rule is None or rule.text != line.value:
+        try:
+            rule = compile(line.value)
+        except ValueError, e:
+            warnings.warn('Malformed RRULE %s (%s); not interpreted' %
+                (line.value, e))
+            return None
+        line.compiled = rule
+    return rule
+
+
+WEEKDAYS = [u'MO', u'TU', u'WE', u'TH', u'FR', u'SA', u'SU']
+
+# Rule parts that expand() understands, by frequency
+SUPPORTED_PARTS = {
+    u'DAILY': set([u'FREQ', u'INTERVAL', u'COUNT', u'UNTIL', u'WKST']),
+    u'WEEKLY': set([u'FREQ', u'INTERVAL', u'COUNT', u'UNTIL', u'WKST',
+        u'BYDAY']),
+    u'MONTHLY': set([u'FREQ', u'INTERVAL', u'COUNT', u'UNTIL', u'WKST',
+        u'BYDAY', u'BYMONTHDAY']),
+    u'YEARLY': set([u'FREQ', u'INTERVAL', u'COUNT', u'UNTIL', u'WKST',
+        u'BYDAY', u'BYMONTHDAY', u'BYMONTH']),
+}
+
+MAX_INSTANCES = 1000000
+
+
+def localize(dt, tzinfo):
+    if hasattr(tzinfo, 'localize'):
+        return tzinfo.localize(dt)      # pytz
+    return dt.replace(tzinfo = tzinfo)
+
+
+def naive(value, tzinfo):
+    '''Return a date, or a datetime as a naive datetime in 'tzinfo'.'''
+    if not hasattr(value, 'time'):
+        return value
+    if value.tzinfo is not None and tzinfo is not None:
+        value = value.astimezone(tzinfo)
+    return value.replace(tzinfo = None)
+
+
+def dayof(value, dtstart):
+    '''
+    Return the day of an UNTIL or EXDATE value as a proleptic Gregorian
+    ordinal, in the timezone of 'dtstart', and the time of day (or None).
+    '''
+    value = naive(value, getattr(dtstart, 'tzinfo', None))
+    if not hasattr(value, 'time'):
+        return value.toordinal(), None
+    return value.toordinal(), value.time()
+
+
+def expandable(rule):
+    '''Can expand() compute the instances of this rule?'''
+    supported = SUPPORTED_PARTS.get(rule.freq)
+    if supported is None:
+        return False
+    for key in rule.params:
+        if key not in supported:
+            return False
+    if rule.byday and rule.freq == u'WEEKLY':
+        for day in rule.byday:
+            if day not in WEEKDAYS:
+                return False            # no ordinal in a weekly rule
+    if rule.freq == u'YEARLY' and not rule.bymonth and \
+            (rule.byday or rule.bymonthday):
+        return False                    # days of every month of the year
+    return True
+
+
+def monthdays(year, month, rule, default):
+    '''Return the days (ordinals) of a month selected by a rule.'''
+    first = datetime.date(year, month, 1).toordinal()
+    if month == 12:
+        length = datetime.date(year + 1, 1, 1).toordinal() - first
+    else:
+        length = datetime.date(year, month + 1, 1).toordinal() - first
+    bymonthday = set()
+    for day in rule.bymonthday or []:
+        if day < 0:
+            day += length + 1
+        if 1 <= day <= length:
+            bymonthday.add(first + day - 1)
+    byday = set()
+    weekday = datetime.date.fromordinal(first).weekday()
+    for day in rule.byday or []:
+        matches = range(first + (WEEKDAYS.index(day[-2:]) - weekday) % 7,
+            first + length, 7)
+        if len(day) > 2:
+            n = int(day[:-2])
+            if n > 0:
+                n -= 1                  # 1 is the first, -1 the last
+            if -len(matches) <= n < len(matches):
+                byday.add(matches[n])
+        else:
+            byday.update(matches)
+    if rule.bymonthday and rule.byday:
+        days = bymonthday & byday
+    elif rule.bymonthday:
+        days = bymonthday
+    elif rule.byday:
+        days = byday
+    elif default <= length:
+        days = [first + default - 1]
+    else:
+        days = []
+    return sorted(days)
+
+
+def expand(rule, dtstart,
+        exdates = None,
+        horizon = None,
+        ):
+    '''
+    Return the instances of a recurrence as an array of days (proleptic
+    Gregorian ordinals, in the timezone of 'dtstart'); every instance starts
+    at the time of day of 'dtstart'. DTSTART is always the first instance.
+    Days with an EXDATE in 'exdates' (a list of dates or datetimes) are
+    excluded. Rules without COUNT or UNTIL are expanded up to the 'horizon'
+    day. Return None if the rule is not supported, or if it never ends and
+    no horizon is given.
+
+    The instances are computed with integer arithmetic on day numbers, in
+    strides over C arrays where the rule allows it, so that long series
+    expand in milliseconds.
+    '''
+    if not expandable(rule):
+        return None
+    start = dtstart.toordinal()
+    tod = None
+    if hasattr(dtstart, 'time'):
+        tod = dtstart.time()
+    last = horizon
+    if rule.until is not None:
+        last, untiltime = dayof(rule.until, dtstart)
+        if tod is not None and untiltime is not None and untiltime < tod:
+            last -= 1
+    if last is None and rule.count is None:
+        return None
+    count = rule.count
+    if count is None:
+        count = MAX_INSTANCES
+    count = min(count, MAX_INSTANCES)
+    interval = rule.interval or 1
+    if last is None:
+        last = start + MAX_INSTANCES * interval * 366
+
+    if rule.freq == u'DAILY':
+        days = array.array('l', xrange(start,
+            min(last, start + interval * (count - 1)) + 1, interval))
+    elif rule.freq == u'WEEKLY':
+        weekdays = rule.byday or [WEEKDAYS[dtstart.weekday()]]
+        wkst = WEEKDAYS.index(rule.wkst or u'MO')
+        weekstart = start - (dtstart.weekday() - wkst) % 7
+        stride = 7 * interval
+        weeks = (count + len(weekdays) - 1) // len(weekdays) + 1
+        end = min(last, weekstart + stride * weeks) + 1
+        days = array.array('l')
+        for weekday in weekdays:
+            offset = (WEEKDAYS.index(weekday) - wkst) % 7
+            days.extend(xrange(weekstart + offset, end, stride))
+        days = array.array('l', sorted(day for day in days if day >= start))
+    else:
+        date = datetime.date.fromordinal(start)
+        if rule.freq == u'MONTHLY':
+            months = [None]
+        else:
+            months = rule.bymonth or [date.month]
+        days = array.array('l')
+        period = 0
+        while len(days) < count:
+            if rule.freq == u'MONTHLY':
+                month = date.month - 1 + period * interval
+                year, month = date.year + month // 12, month % 12 + 1
+                periodmonths = [month]
+            else:
+                year = date.year + period * interval
+                periodmonths = months
+            if year > datetime.MAXYEAR or \
+                    datetime.date(year, 1, 1).toordinal() > last:
+                break
+            for month in periodmonths:
+                days.extend([day
+                    for day in monthdays(year, month, rule, date.day)
+                    if start <= day <= last])
+            period += 1
+    if not days or days[0] != start:
+        days.insert(0, start)
+    del days[count:]
+    while days and days[-1] > last:
+        days.pop()
+
+    if exdates:
+        excluded = set(excludeddays(exdates, dtstart))
+        days = array.array('l', [day for day in days if day not in excluded])
+    return days
+
+
+def excludeddays(exdates, dtstart):
+    '''
+    Return the sorted days of the instances excluded by EXDATE values (dates
+    or datetimes) of a recurrence starting at 'dtstart'.
+    '''
+    tod = None
+    if hasattr(dtstart, 'time'):
+        tod = dtstart.time()
+    days = set()
+    for exdate in exdates:
+        day, time = dayof(exdate, dtstart)
+        if time is None or tod is None or time == tod:
+            days.add(day)
+    return sorted(days)
+
+
+def chunks(days, excluded,
+        max_instances = 0,
+        max_exdates = 0,
+        ):
+    '''
+    Cut the instances of a recurrence ('days', as returned by expand()
+    without EXDATEs) into consecutive series with at most 'max_instances'
+    instances and at most 'max_exdates' of the sorted 'excluded' days each
+    (0 for no limit), in a single pass over both. A series neither starts nor
+    ends on an excluded day, so excluded days between two series are
+    dropped. Return a list of (days, excluded days) pairs.
+    '''
+    result = []
+    chunk = []
+    chunkexcluded = []
+    j = 0
+    for day in days:
+        while j < len(excluded) and excluded[j] < day:
+            j += 1
+        isexcluded = j < len(excluded) and excluded[j] == day
+        if (max_instances and len(chunk) >= max_instances) or \
+                (isexcluded and max_exdates and
+                    len(chunkexcluded) >= max_exdates):
+            result.append(trimchunk(chunk, chunkexcluded))
+            chunk = []
+            chunkexcluded = []
+        if isexcluded:
+            if not chunk:
+                continue
+            chunkexcluded.append(day)
+        chunk.append(day)
+    if chunk:
+        result.append(trimchunk(chunk, chunkexcluded))
+    return result
+
+
+def trimchunk(chunk, excluded):
+    '''Drop the excluded days at the end of a series.'''
+    while excluded and chunk[-1] == excluded[-1]:
+        chunk.pop()
+        excluded.pop()
+    return chunk, excluded
+
+
+def instance(day, dtstart):
+    '''Return the start of the instance of a recurrence on a day.'''
+    date = datetime.date.fromordinal(day)
+    if not hasattr(dtstart, 'time'):
+        return date
+    dt = datetime.datetime.combine(date, dtstart.time())
+    if dtstart.tzinfo is None:
+        return dt
+    return localize(dt, dtstart.tzinfo)
+
+
+def untilvalue(day, dtstart):
+    '''Format the UNTIL value for a series ending on a day.'''
+    dt = instance(day, dtstart)
+    if not hasattr(dt, 'time'):
+        return dt.strftime('%Y%m%d')
+    if dt.tzinfo is None:
+        return dt.strftime('%Y%m%dT%H%M%S')
+    return dt.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def chunkrule(rule, dtstart, days):
+    '''
+    Return the RRULE text for the part of a series from the first to the last
+    of 'days', which must be instances of 'rule'.
+    '''
+    parts = []
+    for kvp in rule.parts:
+        key = kvp.split('=', 1)[0]
+        if key == u'COUNT':
+            continue
+        if key == u'UNTIL':
+            continue
+        parts.append(kvp)
+    parts.append(u'UNTIL=%s' % untilvalue(days[-1], dtstart))
+    return u';'.join(parts)
+
+
+def shift(value, days):
+    '''Move a date or datetime by a number of days, keeping the wall time.'''
+    delta = datetime.timedelta(days = days)
+    if not hasattr(value, 'time') or value.tzinfo is None:
+        return value + delta
+    return localize(naive(value, value.tzinfo) + delta, value.tzinfo)
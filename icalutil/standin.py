@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import atom
+import gdata
+import gdata.calendar
+import gdata.calendar.service
+
+
+TOKEN = 'standin'
+SESSION = 'standin-'      # gdata only keeps session IDs ending with '-'
+QUOTA_BODY = 'The user has exceeded their quota, and cannot currently ' \
+    'perform this operation'
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Google Calendar as far as the uploader sees it: ClientLogin, inserts,
+    batch inserts, updates and deletes, with HTTP/1.1 keep-alive.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1       # Write each response at once; flushed by the base
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status,
+            body = '',
+            reason = None,
+            headers = None,
+            ):
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'application/atom+xml')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readbody(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def accept(self):
+        '''
+        Answer the request like Google Calendar when it doesn't get to do
+        anything: 401 without the token, a 302 to the same URL with a
+        session ID when there is none yet, and a 403 for every
+        'quota_every'-th call. Return whether the request may proceed.
+        '''
+        if self.headers.get('Authorization') != 'GoogleLogin auth=' + TOKEN:
+            self.server.count('unauthorized')
+            self.reply(401, 'Token invalid', 'Unauthorized')
+            return False
+        url = urlparse.urlsplit(self.path)
+        if self.server.redirect and \
+                'gsessionid' not in urlparse.parse_qs(url.query):
+            self.server.count('redirects')
+            if url.query:
+                query = url.query + '&gsessionid=' + SESSION
+            else:
+                query = 'gsessionid=' + SESSION
+            self.reply(302, 'Moved Temporarily',
+                headers = {
+                    'Location': 'http://%s:%d%s?%s' % (
+                        self.server.server_address + (url.path, query)),
+                },
+                )
+            return False
+        if self.server.quota():
+            self.server.count('quota_errors')
+            self.reply(403, QUOTA_BODY, 'Forbidden')
+            return False
+        return True
+
+    def editlink(self):
+        return atom.Link(
+            rel = 'edit',
+            href = 'http://%s:%d/calendar/feeds/default/private/full/' \
+                'standin%d/1' % (self.server.server_address +
+                (self.server.count('links'),)),
+            )
+
+    def do_POST(self):
+        body = self.readbody()
+        path = urlparse.urlsplit(self.path).path
+        if path == '/accounts/ClientLogin':
+            self.server.count('logins')
+            self.reply(200, 'SID=%s\nLSID=%s\nAuth=%s\n' % (TOKEN, TOKEN,
+                TOKEN))
+            return
+        if not self.accept():
+            return
+        if path.endswith('/batch'):
+            feed = gdata.calendar.CalendarEventFeedFromString(body)
+            response = gdata.calendar.CalendarEventFeed()
+            for entry in feed.entry:
+                self.server.count('inserts')
+                response.entry.append(gdata.calendar.CalendarEventEntry(
+                    batch_id = gdata.BatchId(text = entry.batch_id.text),
+                    batch_status = gdata.BatchStatus(code = '201',
+                        reason = 'Created'),
+                    link = [self.editlink()],
+                    ))
+            self.reply(200, str(response))
+            return
+        entry = gdata.calendar.CalendarEventEntryFromString(body)
+        entry.link.append(self.editlink())
+        self.server.count('inserts')
+        self.reply(201, str(entry), 'Created')
+
+    def do_PUT(self):
+        body = self.readbody()
+        if not self.accept():
+            return
+        entry = gdata.calendar.CalendarEventEntryFromString(body)
+        entry.link.append(self.editlink())
+        self.server.count('updates')
+        self.reply(200, str(entry))
+
+    def do_DELETE(self):
+        self.readbody()
+        if not self.accept():
+            return
+        self.server.count('deletes')
+        self.reply(200)
+
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Stand-in for Google Calendar on a local port, for benchmarks and tests of
+    the uploader over real HTTP connections. Counts the connections, logins,
+    calls and errors in 'counts'.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self,
+            quota_every = 0,
+            redirect = True,
+            ):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.quota_every = quota_every
+        self.redirect = redirect
+        self.counts = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count(self, name):
+        '''Count an occurrence of 'name'; return the new count.'''
+        self.lock.acquire()
+        try:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return self.counts[name]
+        finally:
+            self.lock.release()
+
+    def quota(self):
+        '''Should this call exceed the quota?'''
+        self.lock.acquire()
+        try:
+            self.calls += 1
+            return self.quota_every and self.calls % self.quota_every == 0
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+    def service(self):
+        '''Return a CalendarService that talks to this server.'''
+        return gdata.calendar.service.CalendarService(
+            server = '%s:%d' % self.server_address,
+            auth_service_url = 'http://%s:%d/accounts/ClientLogin' %
+                self.server_address,
+            )
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+
+import time
+import datetime
+import calendar
+import collections
+import threading
+
+import pytz
+
+
+class lrucache:
+    '''
+    Mapping of at most 'size' entries that evicts the least recently used
+    entry. Safe to share between threads.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default = None):
+        self.lock.acquire()
+        try:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value       # most recently used
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+
+epochs = lrucache(65536)
+strings = lrucache(65536)
+
+
+def cachekey(value, tz):
+    '''
+    Key of a date (in the timezone 'tz') or a datetime. Aware datetimes are
+    keyed by their timezone and wall time, which is much cheaper to hash than
+    the UTC time. Some timezones can't be hashed (dateutil's tzutc): their
+    datetimes are keyed by UTC offset instead, and their dates are not
+    cached (None).
+    '''
+    if hasattr(value, 'time'):
+        tzinfo = value.tzinfo
+        if getattr(tzinfo, '__hash__', None) is None:
+            tzinfo = value.utcoffset()
+        return tzinfo, value.replace(tzinfo = None)
+    if tz is not None and getattr(tz, '__hash__', None) is None:
+        return None
+    return tz, value
+
+
+def convert(value, tz):
+    if hasattr(value, 'time'):
+        return calendar.timegm(value.utctimetuple())
+    midnight = datetime.datetime.combine(value, datetime.time())
+    if hasattr(tz, 'localize'):
+        midnight = tz.localize(midnight)    # pytz
+    else:
+        midnight = midnight.replace(tzinfo = tz)
+    return calendar.timegm(midnight.utctimetuple())
+
+
+def epoch(value,
+        tz = None,
+        ):
+    '''
+    Return the UTC POSIX timestamp of a datetime, or of midnight of a date in
+    the timezone 'tz'; None is the epoch. Naive datetimes are UTC.
+    '''
+    if value is None:
+        return 0
+    key = cachekey(value, tz)
+    if key is None:
+        return convert(value, tz)
+    seconds = epochs.get(key)
+    if seconds is None:
+        seconds = convert(value, tz)
+        epochs.put(key, seconds)
+    return seconds
+
+
+def epochcolumn(values,
+        tz = None,
+        zones = None,
+        ):
+    '''
+    Return the list of epoch() timestamps of a list of dates and datetimes,
+    converting each distinct value only once. The timezone of the n-th date
+    is zones[n], if given, or 'tz'.
+    '''
+    column = {}
+    result = []
+    for n, value in enumerate(values):
+        if value is None:
+            result.append(0)
+            continue
+        if zones is not None:
+            tz = zones[n]
+        key = cachekey(value, tz)
+        if key is None:
+            result.append(convert(value, tz))
+            continue
+        seconds = column.get(key)
+        if seconds is None:
+            seconds = epochs.get(key)
+            if seconds is None:
+                seconds = convert(value, tz)
+                epochs.put(key, seconds)
+            column[key] = seconds
+        result.append(seconds)
+    return result
+
+
+def rfc3339(value):
+    '''
+    Format a datetime as an RFC 3339 UTC timestamp, or a date as a full-date,
+    as expected by Google Calendar.
+    '''
+    key = cachekey(value, None)
+    text = strings.get(key)
+    if text is None:
+        if hasattr(value, 'time'):
+            text = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                time.gmtime(epoch(value)))
+        else:
+            text = time.strftime('%Y-%m-%d', value.timetuple())
+        strings.put(key, text)
+    return text
+
+
+class zoneregistry:
+    '''
+    Map of the TZIDs of a calendar to timezones, resolved on first use and
+    cached: the pytz timezone of that name if there is one, otherwise the
+    timezone defined by the calendar's VTIMEZONE. Dates without a TZID are in
+    the timezone of the first VTIMEZONE added, or in UTC.
+    '''
+
+    def __init__(self):
+        self.vtimezones = {}
+        self.zones = {}
+        self.default = None
+
+    def add(self, vtimezone):
+        '''Add the definition of a TZID from a VTIMEZONE component.'''
+        tzid = vtimezone.getChildValue('tzid')
+        if not tzid or tzid in self.vtimezones:
+            return
+        self.vtimezones[tzid] = vtimezone
+        if self.default is None:
+            self.default = tzid
+
+    def get(self,
+            tzid = None,
+            ):
+        '''Return the timezone for a TZID, or the default timezone.'''
+        if tzid is None:
+            tzid = self.default
+            if tzid is None:
+                return pytz.utc
+        tz = self.zones.get(tzid)
+        if tz is None:
+            try:
+                tz = pytz.timezone(tzid)
+            except (pytz.UnknownTimeZoneError, UnicodeEncodeError):
+                vtimezone = self.vtimezones.get(tzid)
+                if vtimezone is not None:
+                    tz = vtimezone.gettzinfo()
+                if tz is None:
+                    tz = pytz.utc
+            self.zones[tzid] = tz
+        return tz